@@ -0,0 +1,258 @@
+"""ASGI-режим SkyID.
+
+Запуск (нужны uvicorn или hypercorn; gunicorn из Procfile остается WSGI-режимом):
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+    hypercorn asgi:app --bind 0.0.0.0:8000 --workers 4
+
+Эндпоинты сервисов-потребителей - /oauth/token, /oauth/userinfo,
+/oauth/introspect, /oauth/revoke, /.well-known/jwks.json и
+/.well-known/openid-configuration - обслуживаются
+прямо в цикле событий: соединения (в том числе keep-alive) ничего не стоят,
+пока по ним не пришел запрос, а обращения к хранилищу уходят в пул потоков.
+Логику они берут из тех же функций, что и Flask-маршруты (exchange_code,
+userinfo, introspect, revoke), поэтому ответы совпадают с WSGI-режимом.
+
+Все остальное - страницы, вход и /oauth/authorize - отдается тем же
+Flask-приложением через мост ASGI -> WSGI, который выполняет его в пуле
+потоков (хэширование паролей дополнительно уходит в свой пул, см. passwords.py).
+Туда же уходят запросы к нативным эндпоинтам, отобранные для профилирования:
+профилировщик снимает стеки потока, а не цикла событий (см. profiling.py).
+"""
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+
+import app as skyid
+import metrics
+import profiling
+
+# Потоки для блокирующей работы: запросы к хранилищу и Flask-маршруты
+BLOCKING_WORKERS = int(os.environ.get('SKYID_ASGI_BLOCKING_WORKERS', 32))
+MAX_BODY_SIZE = 1024 * 1024
+
+blocking_executor = ThreadPoolExecutor(BLOCKING_WORKERS, thread_name_prefix='skyid-asgi')
+
+
+def run_blocking(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(blocking_executor, fn, *args)
+
+
+# --- ВСПОМОГАТЕЛЬНОЕ ---
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def issuer(scope):
+    # То же, что request.host_url.rstrip('/') во Flask
+    host = header(scope, b'host') or '%s:%s' % scope['server']
+    return f"{scope.get('scheme', 'http')}://{host}{scope.get('root_path', '')}".rstrip('/')
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+async def read_body(receive):
+    """Тело запроса целиком; None - клиент отключился."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_SIZE:
+            raise BodyTooLarge()
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+def parse_form(scope, body):
+    content_type = (header(scope, b'content-type') or '').split(';')[0].strip().lower()
+    if content_type != 'application/x-www-form-urlencoded':
+        return None  # multipart и прочее разбирает Flask
+    try:
+        return MultiDict(parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+    except UnicodeDecodeError:
+        return None
+
+
+async def check_rate_limit(scope, endpoint, form):
+    args = (endpoint, scope['method'], (scope.get('client') or ('',))[0], form, header(scope, b'authorization'))
+    if skyid.rate_limiter is not None and skyid.rate_limiter.remote:
+        return await run_blocking(skyid.check_rate_limit, *args)
+    # Локальная корзина - микросекунды, в пул потоков не отправляем
+    return skyid.check_rate_limit(*args)
+
+
+async def send_json(send, result):
+    payload, status, headers = result
+    body = (skyid.app.json.dumps(payload) + '\n').encode('utf-8') if payload is not None else b''
+    raw_headers = [(b'content-length', str(len(body)).encode())]
+    if payload is not None:
+        raw_headers.append((b'content-type', b'application/json'))
+    raw_headers += [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# --- НАТИВНЫЕ ОБРАБОТЧИКИ ---
+# Возвращают (payload, status, headers), как и общие функции в app.py
+
+async def token_endpoint(scope, form):
+    try:
+        await check_rate_limit(scope, 'oauth_token', form)
+    except skyid.RateLimited as e:
+        return skyid.rate_limit_error(e)
+    return await run_blocking(skyid.exchange_code, form, issuer(scope), header(scope, b'authorization'),
+                              (scope.get('client') or ('',))[0])
+
+
+async def userinfo_endpoint(scope, form):
+    # Даже для JWT: KeySet может перечитать ключи из БД (неизвестный kid, устаревший набор)
+    return await run_blocking(skyid.userinfo, header(scope, b'authorization'))
+
+
+async def introspect_endpoint(scope, form):
+    return await run_blocking(skyid.introspect, form, header(scope, b'authorization'))
+
+
+async def revoke_endpoint(scope, form):
+    return await run_blocking(skyid.revoke, form, header(scope, b'authorization'))
+
+
+async def jwks_endpoint(scope, form):
+    return await run_blocking(skyid.keyset.jwks), 200, {'Cache-Control': 'public, max-age=3600'}
+
+
+async def discovery_endpoint(scope, form):
+    return skyid.openid_configuration(issuer(scope))
+
+
+# Имена эндпоинтов совпадают с Flask-маршрутами, чтобы метрики обоих режимов сходились
+NATIVE_ROUTES = {
+    ('POST', '/oauth/token'): ('oauth_token', token_endpoint),
+    ('GET', '/oauth/userinfo'): ('oauth_userinfo', userinfo_endpoint),
+    ('POST', '/oauth/introspect'): ('oauth_introspect', introspect_endpoint),
+    ('POST', '/oauth/revoke'): ('oauth_revoke', revoke_endpoint),
+    ('GET', '/.well-known/jwks.json'): ('jwks', jwks_endpoint),
+    ('GET', '/.well-known/openid-configuration'): ('oidc_discovery', discovery_endpoint),
+}
+
+
+# --- МОСТ ASGI -> WSGI ---
+
+def build_environ(scope, body, profile=False):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'SERVER_NAME': (scope.get('server') or ('localhost', 80))[0],
+        'SERVER_PORT': str((scope.get('server') or ('localhost', 80))[1]),
+        'REMOTE_ADDR': (scope.get('client') or ('127.0.0.1', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if profile:
+        environ['skyid.profile'] = True  # выбор уже сделан здесь, Flask не разыгрывает его заново
+    for key, value in scope['headers']:
+        name = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+            continue
+        name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    environ.setdefault('CONTENT_LENGTH', str(len(body)))
+    return environ
+
+
+def start_wsgi(environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    result = skyid.app(environ, start_response)
+    chunks = iter(result)
+    # Первый кусок тела читаем сразу: к этому моменту start_response уже вызван
+    first = next(chunks, b'')
+    return response, result, chunks, first
+
+
+async def call_flask(scope, body, send, profile=False):
+    response, result, chunks, chunk = await run_blocking(start_wsgi, build_environ(scope, body, profile))
+    try:
+        await send({'type': 'http.response.start', 'status': response['status'],
+                    'headers': response['headers']})
+        while True:
+            # Потоковые ответы (генераторы) дочитываем в пуле, не блокируя цикл событий
+            following = await run_blocking(next, chunks, None)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': following is not None})
+            if following is None:
+                break
+            chunk = following
+    finally:
+        if hasattr(result, 'close'):
+            await run_blocking(result.close)
+
+
+# --- ПРИЛОЖЕНИЕ ---
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            skyid.ensure_sweeper()
+            skyid.ensure_webhook_dispatcher()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            blocking_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    try:
+        body = await read_body(receive)
+    except BodyTooLarge:
+        return await send_json(send, ({'error': 'invalid_request', 'message': 'Request body too large'}, 413, {}))
+    if body is None:
+        return
+
+    route = NATIVE_ROUTES.get((scope['method'], scope['path']))
+    if route is not None and skyid.profiler is not None and skyid.profiler.wanted(
+            scope['method'], scope['path'], header(scope, profiling.HEADER.lower().encode())):
+        return await call_flask(scope, body, send, profile=True)
+    if route is not None:
+        endpoint, handler = route
+        form = parse_form(scope, body) if scope['method'] == 'POST' else MultiDict()
+        if form is not None:
+            # Flask-маршруты замеряются хуками metrics.init_app, нативные - здесь
+            with metrics.RequestTimer(endpoint, scope['method']) as timer:
+                result = await handler(scope, form)
+                timer.status = result[1]
+                return await send_json(send, result)
+    await call_flask(scope, body, send)
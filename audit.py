@@ -0,0 +1,156 @@
+"""Журнал аудита SkyID: входы, неудачные входы, выдача кодов, обмен на токены,
+создание приложений, отзыв доступа.
+
+record() только кладет событие в ограниченную очередь процесса - запрос не
+ждет записи. Фоновый поток забирает события пачками (до batch_size или раз в
+flush_interval секунд) и пишет их одной транзакцией или одной записью в файл:
+
+  SQLAuditSink   - таблица audit_log (только INSERT);
+  JSONLAuditSink - файлы audit-ГГГГММДД-pid-N.jsonl в каталоге, новый файл каждые
+                   сутки и при превышении max_bytes.
+
+Если писатель не успевает и очередь заполнена, record() ждет место не дольше
+put_timeout секунд, потом событие отбрасывается и учитывается в stats()
+и в метрике skyid_audit_events_total{result="dropped"}.
+"""
+import atexit
+import heapq
+import json
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+COLUMNS = ['id', 'time', 'event', 'user_id', 'client_id', 'ip', 'details']
+
+
+class SQLAuditSink:
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def write(self, events):
+        self.storage.save_audit_events([(e['ts'], e['event'], e.get('user_id'), e.get('client_id'), e.get('ip'),
+                                         json.dumps(e['details'], ensure_ascii=False) if e['details'] else None)
+                                        for e in events])
+
+
+class JSONLAuditSink:
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._prefix = None
+        self._part = 0
+
+    def _current_path(self):
+        # Свой файл у каждого процесса: воркеры не перемешивают строки друг друга
+        prefix = f"audit-{time.strftime('%Y%m%d', time.gmtime())}-{os.getpid()}"
+        if prefix != self._prefix:
+            self._prefix, self._part = prefix, 0
+        while True:
+            path = os.path.join(self.directory, f'{prefix}-{self._part}.jsonl')
+            if not os.path.exists(path) or os.path.getsize(path) < self.max_bytes:
+                return path
+            self._part += 1
+
+    def write(self, events):
+        os.makedirs(self.directory, exist_ok=True)
+        data = ''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in events)
+        with open(self._current_path(), 'a', encoding='utf-8', opener=lambda p, flags: os.open(p, flags, 0o600)) as f:
+            f.write(data)
+
+
+def _read_file(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def read_jsonl(directory, event=None, user_id=None, client_id=None, since=None, until=None):
+    """События из файлов JSONLAuditSink по времени, с теми же фильтрами, что у БД.
+
+    Внутри файла события идут по порядку, поэтому файлы одного дня (по одному на
+    воркер) сливаются слиянием, открытыми одновременно держатся только они.
+    """
+    if not os.path.isdir(directory):
+        return
+    days = {}
+    for name in os.listdir(directory):
+        if name.startswith('audit-') and name.endswith('.jsonl'):
+            days.setdefault(name.split('-')[1], []).append(os.path.join(directory, name))
+    for day in sorted(days):
+        for e in heapq.merge(*[_read_file(path) for path in days[day]], key=lambda e: e['ts']):
+            if ((event is None or e['event'] == event) and (user_id is None or e.get('user_id') == user_id)
+                    and (client_id is None or e.get('client_id') == client_id)
+                    and (since is None or e['ts'] >= since) and (until is None or e['ts'] < until)):
+                yield e
+
+
+class AuditLog:
+
+    def __init__(self, sink, max_queue=10000, batch_size=500, flush_interval=1.0, put_timeout=0.05):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(max_queue)
+        self._writer_pid = None
+        self._start_lock = threading.Lock()
+        self.written = self.dropped = self.failed = 0
+        atexit.register(self.flush)
+
+    def record(self, event, user_id=None, client_id=None, ip=None, **details):
+        self._ensure_writer()
+        entry = {'ts': time.time(), 'event': event, 'user_id': user_id, 'client_id': client_id, 'ip': ip,
+                 'details': details}
+        try:
+            self._queue.put(entry, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            metrics.audit_events('dropped')
+
+    def _ensure_writer(self):
+        # Поток запускаем в самом воркере: поток мастера gunicorn (--preload) не переживет fork
+        if self._writer_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._writer_pid != os.getpid():
+                self._writer_pid = os.getpid()
+                threading.Thread(target=self._writer_loop, name='skyid-audit', daemon=True).start()
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.sink.write(batch)
+                self.written += len(batch)
+                metrics.audit_events('written', len(batch))
+            except Exception as e:
+                self.failed += len(batch)
+                metrics.audit_events('failed', len(batch))
+                print(f"--- AUDIT: не удалось записать {len(batch)} событий: {e} ---")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self, timeout=5.0):
+        """Ждет, пока писатель запишет все события из очереди (не дольше timeout)."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            if self._writer_pid != os.getpid():
+                return False
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'written': self.written, 'dropped': self.dropped,
+                'failed': self.failed}
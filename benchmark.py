@@ -0,0 +1,582 @@
+"""Нагрузочные тесты и микробенчмарки SkyID.
+
+Полный OAuth-сценарий против локального экземпляра: каждый виртуальный
+пользователь проходит register -> login -> /oauth/authorize (GET и POST)
+-> /oauth/token -> /oauth/userinfo:
+
+    python benchmark.py flow --base-url http://127.0.0.1:5000 --concurrency 16 --iterations 50
+    python benchmark.py flow --spawn --concurrency 16      # поднять свой сервер на временной БД
+
+Микробенчмарки горячих функций в процессе, на временной SQLite:
+
+    python benchmark.py micro
+
+Клиентский SDK (skyid_client.py) против локального экземпляра: один и тот же
+поток запросов профиля - разовыми соединениями без кеша, как пишут сейчас, и
+через SkyIDClient / AsyncSkyIDClient с пулом соединений и кешем:
+
+    python benchmark.py client --spawn --concurrency 8 --requests 2000
+
+Любой режим пишет результаты в JSON (--json FILE), два таких файла можно
+сравнить, чтобы поймать регрессию между релизами:
+
+    python benchmark.py compare old.json new.json --threshold 10
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from urllib.parse import urlencode, urlsplit
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    # Метод ближайшего ранга; умножаем до деления: 99.9 / 100 * 1000 дает 999.0000000000001
+    return sorted_values[max(0, math.ceil(pct * len(sorted_values) / 100) - 1)]
+
+
+def summarize(samples, elapsed=None):
+    """samples - длительности в секундах; результат в миллисекундах."""
+    values = sorted(samples)
+    result = {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0,
+    }
+    if elapsed:
+        result['throughput_rps'] = round(len(values) / elapsed, 1)
+    return result
+
+
+# --- HTTP-КЛИЕНТ ВИРТУАЛЬНОГО ПОЛЬЗОВАТЕЛЯ ---
+
+class Session:
+    """Одно keep-alive соединение и cookie сессии, как у браузера."""
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self.cookies = {}
+        self.conn = None
+
+    def request(self, method, path, form=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # Сервер мог закрыть keep-alive соединение - пробуем один раз на новом
+                self.conn.close()
+                self.conn = None
+                if attempt == 2:
+                    raise
+        for name, value in response.getheaders():
+            if name.lower() == 'set-cookie':
+                cookie = value.split(';', 1)[0]
+                key, _, val = cookie.partition('=')
+                self.cookies[key.strip()] = val.strip()
+        return response.status, dict((k.lower(), v) for k, v in response.getheaders()), data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+# --- СЦЕНАРИЙ ---
+
+FLOW_STEPS = ('register', 'login', 'authorize_get', 'authorize_post', 'token', 'userinfo')
+
+
+class FlowStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.failures = Counter()
+        self.flows_completed = 0
+
+    def record(self, step, status, elapsed, ok):
+        with self.lock:
+            self.latency[step].append(elapsed)
+            self.statuses[step][status] += 1
+            if not ok:
+                self.failures[step] += 1
+
+
+def setup_client(base_url, timeout):
+    """Создает владельца и приложение, возвращает (client_id, api_key)."""
+    s = Session(base_url, timeout)
+    owner = 'bench_owner_' + uuid.uuid4().hex[:8]
+    s.request('POST', '/register', {'username': owner, 'password': 'bench-password', 'name': 'Bench'})
+    s.request('POST', '/login', {'username': owner, 'password': 'bench-password'})
+    s.request('POST', '/dashboard', {'app_name': 'Benchmark', 'redirect_uri': 'http://127.0.0.1/callback'})
+    _, _, html = s.request('GET', '/dashboard')
+    s.close()
+    html = html.decode('utf-8')
+    client_id = re.findall(r'client_id=(\d+)', html)
+    api_key = re.findall(r'key-display">([0-9a-f]{64})<', html)
+    if not client_id or not api_key:
+        raise SystemExit('Не удалось зарегистрировать тестовое приложение: проверьте --base-url')
+    return client_id[-1], api_key[-1]
+
+
+def run_flow(base_url, client_id, api_key, stats, timeout):
+    s = Session(base_url, timeout)
+    username = 'bench_' + uuid.uuid4().hex[:12]
+    password = 'bench-password'
+    authorize_path = f'/oauth/authorize?client_id={client_id}&response_type=code'
+
+    def step(name, expected, method, path, form=None, headers=None):
+        started = time.perf_counter()
+        try:
+            status, response_headers, data = s.request(method, path, form, headers)
+        except (http.client.HTTPException, OSError):
+            stats.record(name, 'connection_error', time.perf_counter() - started, False)
+            return None
+        ok = status == expected
+        stats.record(name, status, time.perf_counter() - started, ok)
+        return (response_headers, data) if ok else None
+
+    try:
+        if not step('register', 302, 'POST', '/register', {'username': username, 'password': password, 'name': 'Bench'}):
+            return
+        if not step('login', 302, 'POST', '/login', {'username': username, 'password': password}):
+            return
+        if not step('authorize_get', 200, 'GET', authorize_path):
+            return
+        result = step('authorize_post', 302, 'POST', authorize_path, {})
+        if not result:
+            return
+        code = re.search(r'[?&]code=([^&]+)', result[0].get('location', ''))
+        if not code:
+            return
+        result = step('token', 200, 'POST', '/oauth/token', {
+            'grant_type': 'authorization_code', 'client_id': client_id,
+            'client_secret': api_key, 'code': code.group(1)})
+        if not result:
+            return
+        access_token = json.loads(result[1])['access_token']
+        if not step('userinfo', 200, 'GET', '/oauth/userinfo', headers={'Authorization': f'Bearer {access_token}'}):
+            return
+        with stats.lock:
+            stats.flows_completed += 1
+    finally:
+        s.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_server(workdir):
+    """Локальный сервер на временной БД; stderr пишется в файл для подсчета ошибок.
+
+    Ограничитель частоты выключен: все виртуальные пользователи ходят с одного IP,
+    и иначе бенчмарк мерил бы отказы 429, а не вход и выдачу токенов.
+    """
+    port = free_port()
+    log = open(os.path.join(workdir, 'server.log'), 'w+')
+    code = f'import sys; sys.path.insert(0, {ROOT!r}); import app; app.app.run(port={port}, threaded=True)'
+    env = dict(os.environ, SKYID_RATE_LIMIT_BACKEND='off')
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=workdir, env=env, stdout=log,
+                               stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process, f'http://127.0.0.1:{port}', log
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit('Сервер не поднялся за 30 секунд, см. ' + log.name)
+
+
+def flow_command(args):
+    process = log = None
+    workdir = tempfile.mkdtemp(prefix='skyid-bench-')
+    base_url = args.base_url
+    if args.spawn:
+        process, base_url, log = spawn_server(workdir)
+    try:
+        client_id, api_key = setup_client(base_url, args.timeout)
+        stats = FlowStats()
+        remaining = [args.iterations * args.concurrency]
+        remaining_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with remaining_lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                run_flow(base_url, client_id, api_key, stats, args.timeout)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    results = {}
+    for name in FLOW_STEPS:
+        summary = summarize(stats.latency[name], elapsed)
+        total = sum(stats.statuses[name].values())
+        summary['errors'] = stats.failures[name]
+        # Отказы ограничителя частоты (против внешнего сервера с --base-url) - отдельно от прочих ошибок
+        summary['rate_limited'] = stats.statuses[name][429]
+        summary['error_rate'] = round(stats.failures[name] / total, 4) if total else 0.0
+        summary['statuses'] = {str(k): v for k, v in sorted(stats.statuses[name].items(), key=str)}
+        results[name] = summary
+    report = {
+        'mode': 'flow',
+        'base_url': base_url,
+        'concurrency': args.concurrency,
+        'flows_started': args.iterations * args.concurrency,
+        'flows_completed': stats.flows_completed,
+        'flows_per_second': round(stats.flows_completed / elapsed, 2),
+        'elapsed_s': round(elapsed, 3),
+        'results': results,
+    }
+    if log is not None:
+        # Блокировки БД видны только на стороне сервера - считаем их по логу
+        log.seek(0)
+        server_log = log.read()
+        report['server_errors'] = {
+            'database_locked': server_log.count('database is locked'),
+            'tracebacks': server_log.count('Traceback (most recent call last)'),
+        }
+    return report
+
+
+# --- МИКРОБЕНЧМАРКИ ---
+
+def measure(fn, seconds, min_runs=20):
+    samples = []
+    deadline = time.perf_counter() + seconds
+    while len(samples) < min_runs or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def micro_command(args):
+    # Приложение импортируется во временном каталоге: БД (skyid.db) создастся там же
+    workdir = tempfile.mkdtemp(prefix='skyid-micro-')
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as skyid
+    from flask import render_template, session
+
+    storage = skyid.storage
+    password_hash = skyid.password_hasher.hash('bench-password')
+    user_id = storage.create_user('bench_user', password_hash, 'Bench')
+    storage.create_app('1000000001', 'k' * 64, user_id, 'Benchmark', 'http://127.0.0.1/callback')
+    token = skyid.issue_jwt({'id': user_id, 'name': 'Bench', 'username': 'bench_user'},
+                            '1000000001', int(time.time()), 'http://bench')
+    opaque_hash = skyid.hash_token('bench-opaque-token')
+    storage.save_access_token(opaque_hash, user_id, '1000000001', int(time.time()), int(time.time()) + 3600)
+    codes = iter(range(10 ** 9))
+
+    def auth_code_roundtrip():
+        code = f'bench-{next(codes)}'
+        storage.save_auth_code(code, user_id, '1000000001')
+        storage.take_auth_code(code, '1000000001', skyid.AUTH_CODE_TTL)
+
+    def code_store_roundtrip():
+        code = f'bench-{next(codes)}'
+        skyid.code_store.save(code, {'user_id': user_id, 'client_id': '1000000001'})
+        skyid.code_store.take(code, '1000000001')
+
+    def render_consent():
+        with skyid.app.test_request_context('/oauth/authorize?client_id=1000000001'):
+            session['user_id'], session['user_name'] = user_id, 'Bench'
+            render_template('authorize.html', app_name='Benchmark', user_name='Bench')
+
+    def pool_acquire():
+        if hasattr(storage, 'pool'):
+            storage.pool.release(storage.pool.acquire())
+        else:
+            with storage.connection():
+                pass
+
+    benchmarks = {
+        'password_hash': lambda: skyid.password_hasher.hash('bench-password'),
+        'password_verify': lambda: skyid.password_hasher.verify(password_hash, 'bench-password'),
+        'db_connection_acquire': pool_acquire,
+        'render_consent_template': render_consent,
+        'sql_get_app': lambda: storage.get_app('1000000001'),
+        'sql_get_user_by_username': lambda: storage.get_user_by_username('bench_user'),
+        'sql_auth_code_save_take': auth_code_roundtrip,
+        'code_store_save_take': code_store_roundtrip,
+        'sql_get_access_token': lambda: storage.get_access_token(opaque_hash, int(time.time())),
+        'client_cache_get': lambda: skyid.get_client('1000000001'),
+        'jwt_encode': lambda: skyid.issue_jwt({'id': user_id, 'name': 'Bench', 'username': 'bench_user'},
+                                              '1000000001', int(time.time()), 'http://bench'),
+        'jwt_decode': lambda: skyid.tokens.decode(token, skyid.keyset),
+    }
+    selected = args.only.split(',') if args.only else list(benchmarks)
+    results = {}
+    for name in selected:
+        samples = measure(benchmarks[name], args.seconds)
+        results[name] = summarize(samples)
+        results[name]['ops_per_second'] = round(len(samples) / sum(samples), 1)
+    return {'mode': 'micro', 'results': results}
+
+
+# --- КЛИЕНТСКИЙ SDK ---
+
+def run_parallel(fn, total, concurrency):
+    """Выполняет fn(i) total раз в concurrency потоках; возвращает (длительности, время, ошибки)."""
+    samples, errors = [], Counter()
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            try:
+                fn(i)
+            except Exception as e:
+                with lock:
+                    errors[type(e).__name__] += 1
+                continue
+            with lock:
+                samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started, errors
+
+
+def issue_tokens(sdk, base_url, count, timeout):
+    """Выпускает count access-токенов одному пользователю: код с PKCE и обмен через SDK."""
+    from skyid_client import generate_code_verifier
+    s = Session(base_url, timeout)
+    username = 'bench_' + uuid.uuid4().hex[:12]
+    s.request('POST', '/register', {'username': username, 'password': 'bench-password', 'name': 'Bench'})
+    s.request('POST', '/login', {'username': username, 'password': 'bench-password'})
+    tokens, samples = [], []
+    for _ in range(count):
+        verifier = generate_code_verifier()
+        url = urlsplit(sdk.authorization_url(state=uuid.uuid4().hex, code_verifier=verifier))
+        _, headers, _ = s.request('POST', f'{url.path}?{url.query}', {})
+        code = re.search(r'[?&]code=([^&]+)', headers.get('location', ''))
+        if not code:
+            raise SystemExit('Сервер не выдал код авторизации: проверьте --base-url')
+        started = time.perf_counter()
+        tokens.append(sdk.exchange_code(code.group(1), code_verifier=verifier)['access_token'])
+        samples.append(time.perf_counter() - started)
+    s.close()
+    return tokens, samples
+
+
+def client_command(args):
+    sys.path.insert(0, ROOT)
+    import asyncio
+    from skyid_client import AsyncSkyIDClient, SkyIDClient
+
+    process = log = None
+    workdir = tempfile.mkdtemp(prefix='skyid-bench-')
+    base_url = args.base_url
+    if args.spawn:
+        process, base_url, log = spawn_server(workdir)
+    try:
+        client_id, api_key = setup_client(base_url, args.timeout)
+        redirect_uri = 'http://127.0.0.1/callback'
+        results = {}
+        with SkyIDClient(base_url, client_id, api_key, redirect_uri=redirect_uri, timeout=args.timeout) as sdk:
+            tokens, samples = issue_tokens(sdk, base_url, args.tokens, args.timeout)
+        results['sdk_exchange_code'] = summarize(samples)
+        parts = urlsplit(base_url)
+
+        def adhoc_userinfo(i):
+            # Новое соединение на каждый вызов и никакого кеша
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=args.timeout)
+            try:
+                conn.request('GET', '/oauth/userinfo', headers={'Authorization': f'Bearer {tokens[i % len(tokens)]}'})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise RuntimeError(f'HTTP {response.status}')
+            finally:
+                conn.close()
+
+        samples, elapsed, errors = run_parallel(adhoc_userinfo, args.requests, args.concurrency)
+        results['adhoc_userinfo'] = dict(summarize(samples, elapsed), server_requests=args.requests,
+                                         errors=sum(errors.values()))
+
+        variants = {
+            'sdk_pooled_userinfo': {'cache_size': 0, 'verify_locally': False},
+            'sdk_cached_userinfo': {},
+        }
+        for name, options in variants.items():
+            with SkyIDClient(base_url, client_id, api_key, timeout=args.timeout,
+                             max_connections=args.concurrency, **options) as sdk:
+                samples, elapsed, errors = run_parallel(lambda i: sdk.userinfo(tokens[i % len(tokens)]),
+                                                        args.requests, args.concurrency)
+                results[name] = dict(summarize(samples, elapsed), server_requests=sdk.stats()['requests'],
+                                     errors=sum(errors.values()))
+
+        async def async_userinfo():
+            samples, errors = [], Counter()
+            semaphore = asyncio.Semaphore(args.concurrency)
+            async with AsyncSkyIDClient(base_url, client_id, api_key, timeout=args.timeout,
+                                        max_connections=args.concurrency) as sdk:
+
+                async def one(i):
+                    async with semaphore:
+                        started = time.perf_counter()
+                        try:
+                            await sdk.userinfo(tokens[i % len(tokens)])
+                        except Exception as e:
+                            errors[type(e).__name__] += 1
+                            return
+                        samples.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                await asyncio.gather(*[one(i) for i in range(args.requests)])
+                elapsed = time.perf_counter() - started
+                return dict(summarize(samples, elapsed), server_requests=sdk.stats()['requests'],
+                            errors=sum(errors.values()))
+
+        results['sdk_async_userinfo'] = asyncio.run(async_userinfo())
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    return {
+        'mode': 'client',
+        'base_url': base_url,
+        'concurrency': args.concurrency,
+        'tokens': args.tokens,
+        'results': results,
+    }
+
+
+# --- СРАВНЕНИЕ ---
+
+def compare_command(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = []
+    print(f"{'benchmark':32} {'metric':16} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name, new in current['results'].items():
+        old = baseline['results'].get(name)
+        if not old:
+            continue
+        for metric, higher_is_better in (('p50_ms', False), ('p95_ms', False), ('p99_ms', False),
+                                         ('throughput_rps', True), ('ops_per_second', True),
+                                         ('error_rate', False)):
+            if metric not in new or metric not in old or not old[metric]:
+                continue
+            change = (new[metric] - old[metric]) / old[metric] * 100
+            worse = -change if higher_is_better else change
+            flag = ' !' if worse > args.threshold else ''
+            if flag:
+                regressions.append((name, metric))
+            print(f"{name:32} {metric:16} {old[metric]:>12} {new[metric]:>12} {change:>8.1f}%{flag}")
+    if regressions:
+        print(f"\nРегрессий хуже {args.threshold}%: {len(regressions)}")
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарки SkyID')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    flow = commands.add_parser('flow', help='нагрузка полным OAuth-сценарием')
+    flow.add_argument('--base-url', default='http://127.0.0.1:5000')
+    flow.add_argument('--spawn', action='store_true', help='запустить свой сервер на временной БД')
+    flow.add_argument('--concurrency', type=int, default=8)
+    flow.add_argument('--iterations', type=int, default=20, help='сценариев на одного виртуального пользователя')
+    flow.add_argument('--timeout', type=float, default=30)
+    flow.add_argument('--json', help='записать результаты в файл')
+
+    micro = commands.add_parser('micro', help='микробенчмарки в процессе')
+    micro.add_argument('--seconds', type=float, default=1.0, help='длительность каждого замера')
+    micro.add_argument('--only', help='список бенчмарков через запятую')
+    micro.add_argument('--json', help='записать результаты в файл')
+
+    client = commands.add_parser('client', help='клиентский SDK против разовых запросов')
+    client.add_argument('--base-url', default='http://127.0.0.1:5000')
+    client.add_argument('--spawn', action='store_true', help='запустить свой сервер на временной БД')
+    client.add_argument('--concurrency', type=int, default=8)
+    client.add_argument('--requests', type=int, default=2000, help='запросов профиля на каждый вариант')
+    client.add_argument('--tokens', type=int, default=20, help='сколько разных токенов выпустить')
+    client.add_argument('--timeout', type=float, default=30)
+    client.add_argument('--json', help='записать результаты в файл')
+
+    compare = commands.add_parser('compare', help='сравнить два JSON-отчета')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=10, help='допустимое ухудшение, %%')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        return compare_command(args)
+
+    handlers = {'flow': flow_command, 'micro': micro_command, 'client': client_command}
+    report = handlers[args.command](args)
+    report['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    report['host'] = {'python': platform.python_version(), 'platform': platform.platform(),
+                      'cpus': os.cpu_count()}
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
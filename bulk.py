@@ -0,0 +1,119 @@
+"""Потоковый перенос записей SkyID в CSV/JSONL и обратно (flask import-data / export-data).
+
+Файл читается и пишется построчно, в память попадает только текущая пачка,
+поэтому размер выгрузки ограничен диском, а не памятью. '-' вместо пути -
+stdin/stdout.
+"""
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+FORMATS = ('csv', 'jsonl')
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+@contextmanager
+def open_file(path, mode):
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+        return
+    # newline='' - csv сам обрабатывает переводы строк внутри полей;
+    # выгрузка содержит хэши паролей и ключи приложений, поэтому только для владельца
+    opener = None if mode == 'r' else (lambda p, flags: os.open(p, flags, 0o600))
+    with open(path, mode, encoding='utf-8', newline='', opener=opener) as f:
+        yield f
+
+
+class BadRecord:
+    """Строка файла, из которой не получилось записи: импорт считает ее ошибкой и идет дальше."""
+
+    __slots__ = ('line', 'reason')
+
+    def __init__(self, line, reason):
+        self.line = line
+        self.reason = reason
+
+    def __str__(self):
+        return f'строка {self.line}: {self.reason}'
+
+
+def read_records(f, fmt):
+    """Словари из файла, по одному на строку JSONL или CSV; вместо битых строк JSONL - BadRecord."""
+    if fmt == 'csv':
+        yield from csv.DictReader(f)
+        return
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield BadRecord(number, f'некорректный JSON ({e.msg})')
+            continue
+        yield record if isinstance(record, dict) else BadRecord(number, 'запись не является объектом')
+
+
+def write_records(f, fmt, columns, rows):
+    """Пишет строки по мере поступления и возвращает их число."""
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(f, columns, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            f.write(json.dumps({column: row[column] for column in columns}, ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Progress:
+    """Пишет в stderr число обработанных записей и скорость не чаще раза в interval секунд."""
+
+    def __init__(self, label, interval=1.0):
+        self.label = label
+        self.interval = interval
+        self.started = self.reported = time.perf_counter()
+        self.processed = 0
+        self.counters = {}
+
+    def update(self, processed, **counters):
+        self.processed += processed
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        now = time.perf_counter()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self._print(now)
+
+    def finish(self):
+        self._print(time.perf_counter(), final=True)
+
+    def _print(self, now, final=False):
+        elapsed = max(now - self.started, 1e-9)
+        details = ''.join(f', {name}: {value}' for name, value in self.counters.items())
+        prefix = 'Готово' if final else '...'
+        print(f"{prefix} {self.label}: {self.processed} записей за {elapsed:.1f} с "
+              f"({self.processed / elapsed:.0f}/с){details}", file=sys.stderr)
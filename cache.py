@@ -0,0 +1,95 @@
+"""Кеши SkyID для редко меняющихся данных (регистрации приложений).
+
+LRUCache  - ограниченный по размеру кеш в памяти процесса с TTL записей.
+RedisCache - общий для всех воркеров gunicorn кеш в Redis (или любом сервере
+             с протоколом Redis); инвалидация в одном воркере видна всем.
+
+Оба считают попадания, промахи и вытеснения - см. stats().
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'backend': 'memory', 'size': len(self._data), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class RedisCache:
+    """Значения хранятся в JSON; вытеснением управляет сам Redis (maxmemory-policy)."""
+
+    def __init__(self, url, ttl=300, prefix='skyid:cache:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('Shared cache requires: pip install redis')
+        self._redis = redis.Redis.from_url(url)
+        self._errors = redis.exceptions
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        raw = self._redis.get(self.prefix + key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self._redis.scan_iter(self.prefix + '*'))
+        if keys:
+            self._redis.delete(*keys)
+
+    def stats(self):
+        try:
+            evicted = self._redis.info('stats').get('evicted_keys', 0)
+        except self._errors.ResponseError:
+            evicted = None  # не все Redis-совместимые серверы поддерживают INFO
+        return {'backend': 'redis', 'hits': self.hits, 'misses': self.misses, 'evictions': evicted}
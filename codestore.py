@@ -0,0 +1,111 @@
+"""Хранилища кодов авторизации SkyID.
+
+Код живет секунды и обменивается на токен ровно один раз, долговечность ему
+не нужна, но обмен может прийти в любой воркер. Поэтому по умолчанию коды
+общие: в Redis, если он настроен, иначе в таблице auth_codes.
+
+  MemoryCodeStore - словарь в памяти процесса, разбитый на сегменты со своими
+                    блокировками; без двух пишущих транзакций на вход, но
+                    годится, только пока процесс один (Procfile, flask run) -
+                    включается явно, SKYID_AUTH_CODE_STORE=memory;
+  RedisCodeStore  - общий для всех воркеров и узлов, срок жизни - EXPIRE;
+  SQLCodeStore    - таблица auth_codes (переживает перезапуск).
+
+Ключ кода - пара (client_id, code): с чужим client_id код не находится и не
+сгорает. take() атомарен: из двух одновременных обменов успешен один.
+"""
+import json
+import threading
+import time
+
+
+class MemoryCodeStore:
+    remote = False
+
+    def __init__(self, ttl, shards=16):
+        self.ttl = ttl
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def save(self, code, data):
+        """data - user_id, client_id и то, к чему привязан код (scope, nonce, redirect_uri, PKCE)."""
+        key = (data['client_id'], code)
+        entries, lock = self._shard(key)
+        with lock:
+            entries[key] = (time.monotonic() + self.ttl, data)
+
+    def take(self, code, client_id):
+        """Забирает код; None - кода нет, он просрочен или уже использован."""
+        key = (client_id, code)
+        entries, lock = self._shard(key)
+        with lock:
+            entry = entries.pop(key, None)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def sweep(self):
+        now = time.monotonic()
+        removed = 0
+        for entries, lock in self._shards:
+            with lock:
+                expired = [key for key, (expires_at, _) in entries.items() if expires_at < now]
+                for key in expired:
+                    del entries[key]
+            removed += len(expired)
+        return removed
+
+    def count(self):
+        return sum(len(entries) for entries, _ in self._shards)
+
+
+class RedisCodeStore:
+    remote = True  # сетевой вызов: ASGI-режим выполняет его в пуле потоков
+
+    def __init__(self, url, ttl, prefix='skyid:code:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('Shared authorization code store requires: pip install redis')
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def save(self, code, data):
+        self._redis.set(f"{self.prefix}{data['client_id']}:{code}", json.dumps(data), ex=self.ttl)
+
+    def take(self, code, client_id):
+        # GETDEL есть только с Redis 6.2; GET и DEL в MULTI так же атомарны
+        with self._redis.pipeline(transaction=True) as pipe:
+            pipe.get(f'{self.prefix}{client_id}:{code}')
+            pipe.delete(f'{self.prefix}{client_id}:{code}')
+            raw, deleted = pipe.execute()
+        return json.loads(raw) if raw is not None and deleted else None
+
+    def sweep(self):
+        return 0  # просроченные ключи удаляет сам Redis
+
+    def count(self):
+        return sum(1 for _ in self._redis.scan_iter(self.prefix + '*', count=1000))
+
+
+class SQLCodeStore:
+    remote = True
+
+    def __init__(self, storage, ttl):
+        self.storage = storage
+        self.ttl = ttl
+
+    def save(self, code, data):
+        self.storage.save_auth_code(code, **data)
+
+    def take(self, code, client_id):
+        return self.storage.take_auth_code(code, client_id, self.ttl)
+
+    def sweep(self):
+        return 0  # строки auth_codes чистит storage.sweep_expired
+
+    def count(self):
+        return self.storage.count_auth_codes()
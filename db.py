@@ -0,0 +1,137 @@
+"""Пул соединений SQLite для SkyID.
+
+Соединение открывается один раз, PRAGMA применяются при открытии, дальше
+оно переиспользуется между запросами вместе со своим кешем подготовленных
+выражений (sqlite3 кеширует их по тексту SQL в пределах соединения).
+Внутри одного потока повторный acquire() возвращает то же соединение.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    pass
+
+
+class ConnectionPool:
+
+    def __init__(self, database, size=8, timeout=10.0, busy_timeout=5000,
+                 cache_size=-16000, mmap_size=64 * 1024 * 1024,
+                 statement_cache=256, health_check_interval=30.0):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.statement_cache = statement_cache
+        self.health_check_interval = health_check_interval
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        # После fork (gunicorn --preload) соединения родителя использовать нельзя
+        self._pid = os.getpid()
+        self._idle = []         # [(conn, released_at)], берем с конца - самое "теплое"
+        self._total = 0
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout / 1000,
+                               check_same_thread=False, cached_statements=self.statement_cache)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        return conn
+
+    def _healthy(self, conn, released_at):
+        if time.monotonic() - released_at < self.health_check_interval:
+            return True
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            with self._cond:
+                if self._pid != os.getpid():
+                    self._reset()
+
+        local = self._local
+        if getattr(local, 'conn', None) is not None:
+            local.depth += 1
+            return local.conn
+
+        conn = None
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while conn is None:
+                if self._idle:
+                    candidate, released_at = self._idle.pop()
+                    if self._healthy(candidate, released_at):
+                        conn = candidate
+                    else:
+                        self._total -= 1
+                        candidate.close()
+                elif self._total < self.size:
+                    self._total += 1
+                    break
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f'no free database connection in {self.timeout}s')
+                    self._cond.wait(remaining)
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except BaseException:
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                raise
+        local.conn = conn
+        local.depth = 1
+        return conn
+
+    def release(self, conn):
+        local = self._local
+        if getattr(local, 'conn', None) is not conn:
+            return
+        local.depth -= 1
+        if local.depth:
+            return
+        local.conn = None
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            conn.close()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._cond:
+            return {'size': self.size, 'open': self._total, 'idle': len(self._idle)}
+
@@ -0,0 +1,7 @@
+# Настройки gunicorn (файл подхватывается автоматически из рабочего каталога)
+import metrics
+
+
+def child_exit(server, worker):
+    # Метрики в режиме PROMETHEUS_MULTIPROC_DIR: убираем live-значения умершего воркера
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,279 @@
+"""Метрики SkyID в формате Prometheus (эндпоинт /metrics).
+
+Нужен пакет prometheus-client; без него (или при SKYID_METRICS=0) все
+функции модуля ничего не делают, а /metrics не регистрируется.
+
+Несколько воркеров gunicorn: задайте PROMETHEUS_MULTIPROC_DIR - пустой
+каталог, который очищается перед каждым запуском. Каждый воркер пишет
+значения в свои mmap-файлы, /metrics в любом воркере суммирует их все.
+Хук child_exit для умерших воркеров - в gunicorn.conf.py.
+
+Что собирается:
+  skyid_http_request_duration_seconds{endpoint,method}  - время запроса
+  skyid_http_requests_total{endpoint,method,status}
+  skyid_http_requests_in_flight{endpoint}
+  skyid_stage_duration_seconds{stage}  - db_connect, password_hash,
+      password_verify, template_render, redirect
+  skyid_db_query_duration_seconds{query} - по методам Storage
+  skyid_auth_codes_issued_total, skyid_auth_codes_redeemed_total
+  skyid_consent_skipped_total - коды, выданные по запомненному согласию без страницы подтверждения
+  skyid_token_requests_total{result} - success, invalid_client, invalid_grant...
+  skyid_webhook_events_total{result} - события вебхуков: delivered, retry, dead
+  skyid_audit_events_total{result} - события журнала аудита: written, dropped, failed
+  skyid_rate_limited_total{rule} - отказы ограничителя частоты (ключи - flask rate-limits)
+  skyid_client_cache_total{result} - кеш приложений: hit, miss, eviction (вытеснения
+      считаются только для кеша в памяти; в Redis это evicted_keys самого сервера)
+  skyid_auth_codes - действующих кодов авторизации (считается при опросе)
+
+Замер - два вызова perf_counter и observe() по заранее выбранной серии,
+единицы микросекунд на запрос, поэтому метрики можно держать включенными.
+"""
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:  # pragma: no cover - prometheus-client необязателен
+    prometheus_client = None
+
+ENABLED = prometheus_client is not None and os.environ.get('SKYID_METRICS', '1') != '0'
+MULTIPROCESS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+REQUEST_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+STAGE_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+if ENABLED:
+    REQUEST_DURATION = Histogram('skyid_http_request_duration_seconds', 'Время обработки запроса',
+                                 ['endpoint', 'method'], buckets=REQUEST_BUCKETS)
+    REQUESTS = Counter('skyid_http_requests_total', 'Обработанные запросы', ['endpoint', 'method', 'status'])
+    IN_FLIGHT = Gauge('skyid_http_requests_in_flight', 'Запросы в обработке', ['endpoint'],
+                      multiprocess_mode='livesum')
+    STAGE_DURATION = Histogram('skyid_stage_duration_seconds', 'Время этапов внутри запросов',
+                               ['stage'], buckets=STAGE_BUCKETS)
+    QUERY_DURATION = Histogram('skyid_db_query_duration_seconds', 'Время операций хранилища',
+                               ['query'], buckets=STAGE_BUCKETS)
+    CODES_ISSUED = Counter('skyid_auth_codes_issued_total', 'Выданные коды авторизации')
+    CODES_REDEEMED = Counter('skyid_auth_codes_redeemed_total', 'Обмененные на токен коды авторизации')
+    CONSENT_SKIPPED = Counter('skyid_consent_skipped_total', 'Коды, выданные по запомненному согласию')
+    TOKEN_REQUESTS = Counter('skyid_token_requests_total', 'Запросы /oauth/token по результату', ['result'])
+    WEBHOOK_EVENTS = Counter('skyid_webhook_events_total', 'События вебхуков по итогу попытки доставки',
+                             ['result'])
+    AUDIT_EVENTS = Counter('skyid_audit_events_total', 'События журнала аудита по результату', ['result'])
+    RATE_LIMITED = Counter('skyid_rate_limited_total', 'Запросы, отклоненные ограничителем частоты', ['rule'])
+    CLIENT_CACHE = Counter('skyid_client_cache_total', 'Обращения к кешу приложений по результату', ['result'])
+
+
+# --- ЗАПРОСЫ ---
+
+class RequestTimer:
+    """Замер одного запроса: in-flight на время жизни, итог - в finish()."""
+
+    __slots__ = ('endpoint', 'method', 'status', 'started')
+
+    def __init__(self, endpoint, method):
+        self.endpoint = endpoint
+        self.method = method
+        self.status = 500  # если ответ так и не был сформирован
+        self.started = time.perf_counter()
+        if ENABLED:
+            IN_FLIGHT.labels(endpoint).inc()
+
+    def finish(self):
+        if ENABLED:
+            IN_FLIGHT.labels(self.endpoint).dec()
+            REQUEST_DURATION.labels(self.endpoint, self.method).observe(time.perf_counter() - self.started)
+            REQUESTS.labels(self.endpoint, self.method, str(self.status)).inc()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finish()
+
+
+# --- СОБЫТИЯ ---
+
+def code_issued():
+    if ENABLED:
+        CODES_ISSUED.inc()
+
+
+def code_redeemed():
+    if ENABLED:
+        CODES_REDEEMED.inc()
+
+
+def consent_skipped():
+    if ENABLED:
+        CONSENT_SKIPPED.inc()
+
+
+def token_request(result):
+    if ENABLED:
+        TOKEN_REQUESTS.labels(result).inc()
+
+
+def webhook_events(result, count=1):
+    if ENABLED and count:
+        WEBHOOK_EVENTS.labels(result).inc(count)
+
+
+def audit_events(result, count=1):
+    if ENABLED:
+        AUDIT_EVENTS.labels(result).inc(count)
+
+
+def rate_limited(rule):
+    if ENABLED:
+        RATE_LIMITED.labels(rule).inc()
+
+
+# --- ЭТАПЫ ---
+
+def timed(fn, histogram):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+
+def instrument_storage(storage, methods):
+    """Оборачивает методы хранилища (и взятие соединения) замерами на уровне экземпляра."""
+    for name in methods:
+        method = getattr(storage, name)
+        if inspect.isgeneratorfunction(method):
+            # Вызов генератора только создает его, а время чтения смешано со временем
+            # потребителя (запись выгрузки в файл) - такие методы не замеряем
+            continue
+        setattr(storage, name, timed(method, QUERY_DURATION.labels(name)))
+
+    connect = storage.connection
+    connect_duration = STAGE_DURATION.labels('db_connect')
+
+    @contextmanager
+    def connection():
+        started = time.perf_counter()
+        with connect() as conn:
+            connect_duration.observe(time.perf_counter() - started)
+            yield conn
+
+    storage.connection = connection
+
+
+def instrument_cache(cache):
+    """Переносит счетчики кеша приложений (cache.py, stats()) в метрики."""
+    get, put = cache.get, cache.set
+    hit, miss, eviction = CLIENT_CACHE.labels('hit'), CLIENT_CACHE.labels('miss'), CLIENT_CACHE.labels('eviction')
+
+    def counted_get(key):
+        value = get(key)
+        (miss if value is None else hit).inc()
+        return value
+
+    cache.get = counted_get
+    if not hasattr(cache, 'evictions'):
+        return
+
+    lock = threading.Lock()
+    reported = [cache.evictions]
+
+    def counted_set(key, value):
+        put(key, value)
+        # Вытесняет сам set(); разницу считаем под блокировкой, чтобы параллельные
+        # вызовы не учли одно вытеснение дважды
+        with lock:
+            evicted, reported[0] = cache.evictions - reported[0], cache.evictions
+        if evicted:
+            eviction.inc(evicted)
+
+    cache.set = counted_set
+
+
+class AppStateCollector:
+    """Значения, которые дешевле посчитать при опросе, чем поддерживать на лету."""
+
+    def __init__(self, code_store):
+        self.code_store = code_store
+
+    def describe(self):
+        # Иначе реестр вызовет collect() прямо при регистрации, до создания таблиц
+        yield GaugeMetricFamily('skyid_auth_codes', 'Действующие коды авторизации')
+
+    def collect(self):
+        yield GaugeMetricFamily('skyid_auth_codes', 'Действующие коды авторизации',
+                                value=self.code_store.count())
+
+
+def init_app(app, storage, storage_methods, password_hasher, code_store, client_cache):
+    if not ENABLED:
+        return
+    from flask import before_render_template, g, request, template_rendered
+
+    instrument_storage(storage, storage_methods)
+    instrument_cache(client_cache)
+    password_hasher.hash = timed(password_hasher.hash, STAGE_DURATION.labels('password_hash'))
+    password_hasher.verify = timed(password_hasher.verify, STAGE_DURATION.labels('password_verify'))
+    # flask.redirect() строит ответ через app.redirect - подменяем на экземпляре
+    app.redirect = timed(app.redirect, STAGE_DURATION.labels('redirect'))
+
+    render_duration = STAGE_DURATION.labels('template_render')
+
+    def render_started(sender, template, context, **extra):
+        g._metrics_render_started = time.perf_counter()
+
+    def render_finished(sender, template, context, **extra):
+        started = g.pop('_metrics_render_started', None)
+        if started is not None:
+            render_duration.observe(time.perf_counter() - started)
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+    @app.before_request
+    def start_request_timer():
+        g._metrics_timer = RequestTimer(request.endpoint or 'unmatched', request.method)
+
+    @app.after_request
+    def record_response_status(response):
+        timer = g.get('_metrics_timer')
+        if timer is not None:
+            timer.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_timer(exc):
+        timer = g.pop('_metrics_timer', None)
+        if timer is not None:
+            timer.finish()
+
+    state_collector = AppStateCollector(code_store)
+    if not MULTIPROCESS_DIR:
+        prometheus_client.REGISTRY.register(state_collector)
+
+    @app.route('/metrics')
+    def metrics():
+        if MULTIPROCESS_DIR:
+            # Реестр на каждый опрос: значения всех воркеров читаются из файлов
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            registry.register(state_collector)
+        else:
+            registry = prometheus_client.REGISTRY
+        return prometheus_client.generate_latest(registry), 200, {
+            'Content-Type': prometheus_client.CONTENT_TYPE_LATEST}
+
+
+def mark_process_dead(pid):
+    """Для хука gunicorn child_exit: убирает live-значения завершившегося воркера."""
+    if ENABLED and MULTIPROCESS_DIR:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,222 @@
+"""Хэширование паролей SkyID.
+
+Пароли хэшируются солёной memory-hard функцией: Argon2id (пакет argon2-cffi)
+или scrypt из стандартной библиотеки, если argon2-cffi не установлен.
+Старые хэши (несолёный SHA-256, 64 hex-символа) по-прежнему проверяются и
+при успешном входе помечаются на перехэширование.
+
+Хэширование намеренно дорогое, поэтому выполняется в ограниченном пуле
+потоков (argon2 и scrypt отпускают GIL). Если в очереди уже max_queue
+задач, вызов сразу падает с HasherBusy - шторм логинов не занимает
+воркеры, обслуживающие /oauth/token и /oauth/userinfo.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import argon2
+    from argon2.exceptions import InvalidHashError, VerificationError
+except ImportError:  # pragma: no cover - argon2-cffi необязателен
+    argon2 = None
+
+LEGACY_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+SCRYPT_FORMAT = re.compile(r'^\$scrypt\$ln=(\d+),r=(\d+),p=(\d+)\$([A-Za-z0-9+/]+)\$([A-Za-z0-9+/]+)$')
+
+
+class HasherBusy(Exception):
+    """Очередь хэширования переполнена, запрос нужно повторить позже."""
+
+
+def _b64(data):
+    return base64.b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _unb64(data):
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+def legacy_sha256(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+# --- АЛГОРИТМЫ ---
+
+class Argon2idScheme:
+    name = 'argon2id'
+
+    def __init__(self, time_cost=3, memory_cost=65536, parallelism=4):
+        if argon2 is None:
+            raise RuntimeError('Argon2id requires: pip install argon2-cffi')
+        self.params = {'time_cost': time_cost, 'memory_cost': memory_cost, 'parallelism': parallelism}
+        self._hasher = argon2.PasswordHasher(time_cost=time_cost, memory_cost=memory_cost,
+                                             parallelism=parallelism, type=argon2.Type.ID)
+
+    def identify(self, stored):
+        return stored.startswith('$argon2')
+
+    def hash(self, password):
+        return self._hasher.hash(password)
+
+    def verify(self, stored, password):
+        try:
+            return self._hasher.verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def needs_rehash(self, stored):
+        return self._hasher.check_needs_rehash(stored)
+
+
+class ScryptScheme:
+    name = 'scrypt'
+
+    def __init__(self, ln=15, r=8, p=1):
+        self.params = {'ln': ln, 'r': r, 'p': p}
+
+    @staticmethod
+    def _derive(password, salt, ln, r, p):
+        n = 1 << ln
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * r * (n + p) + (1 << 20), dklen=32)
+
+    def identify(self, stored):
+        return stored.startswith('$scrypt$')
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        ln, r, p = self.params['ln'], self.params['r'], self.params['p']
+        return f'$scrypt$ln={ln},r={r},p={p}${_b64(salt)}${_b64(self._derive(password, salt, ln, r, p))}'
+
+    def verify(self, stored, password):
+        match = SCRYPT_FORMAT.match(stored)
+        if not match:
+            return False
+        ln, r, p = (int(v) for v in match.group(1, 2, 3))
+        expected = _unb64(match.group(5))
+        return hmac.compare_digest(self._derive(password, _unb64(match.group(4)), ln, r, p), expected)
+
+    def needs_rehash(self, stored):
+        match = SCRYPT_FORMAT.match(stored)
+        return not match or tuple(int(v) for v in match.group(1, 2, 3)) != (
+            self.params['ln'], self.params['r'], self.params['p'])
+
+
+def is_supported_hash(stored):
+    """Хэш в формате, который PasswordHasher умеет проверить (для импорта готовых хэшей)."""
+    if LEGACY_SHA256.match(stored) or SCRYPT_FORMAT.match(stored):
+        return True
+    return argon2 is not None and stored.startswith('$argon2')
+
+
+def default_algorithm():
+    return 'argon2id' if argon2 is not None else 'scrypt'
+
+
+# --- ПУЛ ХЭШИРОВАНИЯ ---
+
+class PasswordHasher:
+
+    def __init__(self, scheme, workers=4, max_queue=16):
+        self.scheme = scheme
+        self.workers = workers
+        self.max_queue = max_queue
+        # Разрешений столько, сколько задач может быть в работе и в очереди одновременно
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._dummy_hash = None
+        self.rejected = 0
+
+    def _pool(self):
+        # Пул создается в процессе воркера: потоки не переживают fork
+        if self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='skyid-hash')
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HasherBusy('password hashing queue is full')
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self._run(self.scheme.hash, password)
+
+    def verify(self, stored, password):
+        """Возвращает (пароль_верный, нужно_перехэшировать).
+
+        stored=None (пользователь не найден) проверяется против фиктивного
+        хэша, чтобы по времени ответа нельзя было перебирать логины.
+        """
+        return self._run(self._verify, stored, password)
+
+    def _verify(self, stored, password):
+        if stored is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = self.scheme.hash(secrets.token_urlsafe(16))
+            self.scheme.verify(self._dummy_hash, password)
+            return False, False
+        if LEGACY_SHA256.match(stored):
+            return hmac.compare_digest(stored, legacy_sha256(password)), True
+        for scheme in (self.scheme, *self._other_schemes()):
+            if scheme.identify(stored):
+                ok = scheme.verify(stored, password)
+                return ok, ok and (scheme is not self.scheme or scheme.needs_rehash(stored))
+        return False, False
+
+    def _other_schemes(self):
+        # Хэши, созданные до смены алгоритма, проверяем схемой с параметрами по умолчанию
+        # (параметры все равно читаются из самого хэша)
+        if self.scheme.name != 'scrypt':
+            yield ScryptScheme()
+        if self.scheme.name != 'argon2id' and argon2 is not None:
+            yield Argon2idScheme()
+
+
+# --- КАЛИБРОВКА ---
+
+def calibrate(algorithm, target_ms, memory_cost=65536, parallelism=4, rounds=3):
+    """Подбирает параметры, при которых один хэш занимает не меньше target_ms на этом хосте."""
+
+    def measure(scheme):
+        best = None
+        for _ in range(rounds):
+            started = time.perf_counter()
+            scheme.hash('calibration-password')
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    if algorithm == 'argon2id':
+        time_cost = 1
+        while True:
+            scheme = Argon2idScheme(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+            elapsed = measure(scheme)
+            if elapsed >= target_ms or time_cost >= 50:
+                return scheme.params, elapsed
+            time_cost += 1
+
+    ln = 12
+    while True:
+        scheme = ScryptScheme(ln=ln)
+        elapsed = measure(scheme)
+        if elapsed >= target_ms or ln >= 22:
+            return scheme.params, elapsed
+        ln += 1
@@ -0,0 +1,220 @@
+"""Выборочное профилирование запросов SkyID в работающем воркере.
+
+Профилируется случайная доля запросов (sample_rate) и любой запрос с
+заголовком X-SkyID-Admin, подписанным секретом администратора:
+
+    X-SkyID-Admin: t=<unix time>,v1=<hex HMAC-SHA256(secret, "<t>.<METHOD> <path>")>
+
+(flask profile-header METHOD PATH печатает готовый заголовок). Подпись
+привязана к методу и пути и действует signature_ttl секунд.
+
+Профилировщик статистический: отдельный поток раз в interval секунд снимает
+стеки потоков, которые сейчас выполняют отобранные запросы
+(sys._current_frames), - сам запрос ничего не замеряет и не замедляется.
+Итог - файл в формате collapsed stacks (flamegraph.pl, speedscope,
+inferno), корень каждого стека - имя Flask-эндпоинта:
+
+    oauth_token;...;Flask.wsgi_app (app.py:1479);...;SQLStorage.get_user (storage.py:212) 7
+
+Файлы лежат в каталоге directory, хранятся последние max_files. Запрос
+короче interval может не попасть ни в один отсчет - такие профили не пишутся;
+для быстрых эндпоинтов включайте sample_rate и смотрите сумму профилей
+(/admin/profiles/merged?endpoint=...).
+
+Когда профилирование не настроено, профилировщик не создается и хуки не
+регистрируются - выключенный, он ничего не стоит.
+"""
+import hashlib
+import hmac
+import itertools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+HEADER = 'X-SkyID-Admin'
+PROFILE_NAME = re.compile(r'(\d{8}T\d{6}\.\d{3})-(\d+)-(\d+)-(\d+)ms-([\w.]+)\.folded')
+MAX_DEPTH = 128
+
+
+def sign(secret, method, path, timestamp):
+    message = f'{timestamp}.{method.upper()} {path}'.encode()
+    mac = hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={mac}'
+
+
+def verify(secret, method, path, value, ttl):
+    """Подписан ли заголовок этим секретом для этого запроса и не устарел ли он."""
+    if not secret or not value:
+        return False
+    fields = dict(part.strip().partition('=')[::2] for part in value.split(','))
+    timestamp = fields.get('t', '')
+    if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > ttl:
+        return False
+    return hmac.compare_digest(sign(secret, method, path, timestamp), f"t={timestamp},v1={fields.get('v1', '')}")
+
+
+class Profile:
+    __slots__ = ('endpoint', 'thread_id', 'started', 'stacks')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.stacks = Counter()
+
+
+class SamplingProfiler:
+
+    def __init__(self, directory, sample_rate=0.0, secret=None, interval=0.005, max_files=500,
+                 signature_ttl=300):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.interval = interval
+        self.max_files = max_files
+        self.signature_ttl = signature_ttl
+        self._active = {}                  # thread_id -> Profile
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()   # поток отсчетов спит, пока профилировать нечего
+        self._labels = {}                  # code -> подпись кадра
+        self._sequence = itertools.count()
+        self._sampler_pid = None
+
+    def wanted(self, method, path, header_value):
+        """Профилировать ли запрос: выпал по доле или пришел с подписанным заголовком."""
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        return header_value is not None and self.is_admin(method, path, header_value)
+
+    def is_admin(self, method, path, header_value):
+        return verify(self.secret, method, path, header_value, self.signature_ttl)
+
+    # --- ОТСЧЕТЫ ---
+
+    def start(self, endpoint):
+        """Начинает профилировать текущий поток; результат - в finish()."""
+        self._ensure_sampler()
+        profile = Profile(endpoint)
+        with self._lock:
+            self._active[profile.thread_id] = profile
+        self._wakeup.set()
+        return profile
+
+    def finish(self, profile):
+        """Останавливает профиль и записывает его; путь к файлу или None, если отсчетов нет."""
+        with self._lock:
+            self._active.pop(profile.thread_id, None)
+            if not self._active:
+                self._wakeup.clear()
+            # Снимок под блокировкой: поток отсчетов мог как раз дописывать последний стек
+            stacks = dict(profile.stacks)
+        if not stacks:
+            return None
+        return self._write(profile.endpoint, stacks, time.perf_counter() - profile.started)
+
+    def _ensure_sampler(self):
+        # Поток запускаем в самом воркере: поток мастера gunicorn (--preload) не переживет fork
+        if self._sampler_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sampler_pid != os.getpid():
+                self._sampler_pid = os.getpid()
+                threading.Thread(target=self._sampler_loop, name='skyid-profiler', daemon=True).start()
+
+    def _sampler_loop(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.values())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            samples = [(profile, self._collapse(frames[profile.thread_id]))
+                       for profile in active if profile.thread_id in frames]
+            del frames  # кадры держат локальные переменные запросов
+            with self._lock:
+                for profile, stack in samples:
+                    # Запрос мог закончиться, пока снимались стеки: его профиль уже записан
+                    if self._active.get(profile.thread_id) is profile:
+                        profile.stacks[stack] += 1
+
+    def _collapse(self, frame):
+        labels = []
+        while frame is not None and len(labels) < MAX_DEPTH:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                name = getattr(code, 'co_qualname', code.co_name)
+                label = self._labels[code] = f'{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            labels.append(label)
+            frame = frame.f_back
+        return ';'.join(reversed(labels))
+
+    # --- ФАЙЛЫ ---
+
+    def _write(self, endpoint, stacks, duration):
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        name = (f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}.{int(now * 1000) % 1000:03d}-{os.getpid()}-"
+                f"{next(self._sequence)}-{int(duration * 1000)}ms-{endpoint}.folded")
+        path = os.path.join(self.directory, name)
+        data = ''.join(f'{endpoint};{stack} {count}\n' for stack, count in stacks.items())
+        with open(path, 'w', encoding='utf-8', opener=lambda p, flags: os.open(p, flags, 0o600)) as f:
+            f.write(data)
+        self._rotate()
+        return path
+
+    def _names(self):
+        if not os.path.isdir(self.directory):
+            return []
+        # Имя начинается со времени создания, поэтому сортировка по имени - по времени
+        return sorted(name for name in os.listdir(self.directory) if PROFILE_NAME.fullmatch(name))
+
+    def _rotate(self):
+        names = self._names()
+        for name in names[:max(0, len(names) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass  # файл уже удалил другой воркер
+
+    def list_profiles(self, endpoint=None):
+        """Профили от новых к старым."""
+        profiles = []
+        for name in reversed(self._names()):
+            created, pid, _, duration, profile_endpoint = PROFILE_NAME.fullmatch(name).groups()
+            if endpoint and profile_endpoint != endpoint:
+                continue
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            profiles.append({'name': name, 'endpoint': profile_endpoint, 'created_at': created,
+                             'duration_ms': int(duration), 'pid': int(pid), 'size': size})
+        return profiles
+
+    def profile_path(self, name):
+        """Путь к профилю по имени из list_profiles(); None - имени нет или оно чужое."""
+        if not PROFILE_NAME.fullmatch(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def merged(self, endpoint=None):
+        """Сумма стеков всех профилей (или профилей одного эндпоинта) в том же формате."""
+        stacks = Counter()
+        for profile in self.list_profiles(endpoint):
+            try:
+                with open(os.path.join(self.directory, profile['name']), encoding='utf-8') as f:
+                    for line in f:
+                        stack, _, count = line.rstrip('\n').rpartition(' ')
+                        if count.isdigit():
+                            stacks[stack] += int(count)
+            except FileNotFoundError:
+                continue
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
@@ -0,0 +1,231 @@
+"""Ограничение частоты запросов SkyID (token bucket).
+
+У каждого правила - емкость корзины (допустимый всплеск) и скорость
+пополнения в токенах в секунду. Запрос списывает токен из корзины
+"правило:ключ" (ключ - client_id, логин или IP); пустая корзина означает
+429 и время, через которое появится следующий токен.
+
+Хранилища корзин:
+  MemoryRateLimiter - словарь в памяти процесса (один воркер, тесты);
+  MmapRateLimiter   - хэш-таблица фиксированного размера в файле, отображенном
+                      в память: общая для всех воркеров gunicorn на хосте,
+                      проверка - одна блокировка и чтение/запись 64 байт;
+  RedisRateLimiter  - Lua-скрипт в Redis (или совместимом сервере) для
+                      нескольких хостов.
+
+Для каждого ключа считаются пропущенные и отклоненные запросы - см. stats().
+"""
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows: общий файл недоступен
+    fcntl = None
+
+
+class RateLimited(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__(f'rate limit exceeded, retry after {retry_after:.1f}s')
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+def _refill(tokens, updated, now, capacity, rate):
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+class MemoryRateLimiter:
+    remote = False
+
+    def __init__(self, rules, max_keys=65536):
+        self.rules = rules
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # 'правило:ключ' -> [tokens, updated, allowed, rejected]
+        self._lock = threading.Lock()
+
+    def hit(self, rule, key):
+        """Списывает токен; возвращает 0, если запрос пропущен, иначе секунды до повтора."""
+        capacity, rate = self.rules[rule]
+        name = f'{rule}:{key}'
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                bucket = self._buckets[name] = [capacity, now, 0, 0]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(name)
+            tokens = _refill(bucket[0], bucket[1], now, capacity, rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                bucket[2] += 1
+                return 0
+            bucket[0] = tokens
+            bucket[3] += 1
+            return (1 - tokens) / rate
+
+    def stats(self, limit=20):
+        with self._lock:
+            rows = [{'key': name, 'allowed': b[2], 'rejected': b[3], 'tokens': round(b[0], 2)}
+                    for name, b in self._buckets.items()]
+        return sorted(rows, key=lambda row: (-row['rejected'], -row['allowed']))[:limit]
+
+
+class MmapRateLimiter:
+    """Корзины в общем файле. Слот: хэш ключа, токены, время, счетчики и начало ключа.
+
+    Ключ ищется линейным пробированием не дальше PROBES слотов; если все они
+    заняты, вытесняется самая давно обновленная корзина (она почти наверняка
+    уже полна, так что потеря состояния ничего не меняет).
+    """
+
+    remote = False
+    SLOT = struct.Struct('<QddII32s')  # 64 байта - одна строка кеша
+    PROBES = 8
+
+    def __init__(self, path, rules, slots=65536):
+        if fcntl is None:
+            raise RuntimeError('Shared-memory rate limiting requires fcntl (Linux/macOS)')
+        self.path = path
+        self.rules = rules
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        # Открываем файл в каждом процессе: flock на дескрипторе, унаследованном
+        # через fork, не разделял бы воркеров между собой
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(fd).st_size
+            if size < self.SLOT.size or size % self.SLOT.size:
+                size = self.slots * self.SLOT.size
+                os.ftruncate(fd, size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.slots = size // self.SLOT.size
+        self._fd, self._map, self._pid = fd, mmap.mmap(fd, size), os.getpid()
+
+    @staticmethod
+    def _hash(name):
+        # hash() у строк рандомизирован в каждом процессе - нужен стабильный
+        return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little') or 1
+
+    def _find(self, key_hash):
+        start = key_hash % self.slots
+        victim, victim_updated = None, None
+        for i in range(self.PROBES):
+            offset = (start + i) % self.slots * self.SLOT.size
+            slot = self.SLOT.unpack_from(self._map, offset)
+            if slot[0] == key_hash:
+                return offset, slot
+            if slot[0] == 0:
+                return offset, None
+            if victim is None or slot[2] < victim_updated:
+                victim, victim_updated = offset, slot[2]
+        return victim, None
+
+    def hit(self, rule, key):
+        capacity, rate = self.rules[rule]
+        name = f'{rule}:{key}'
+        key_hash = self._hash(name)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                offset, slot = self._find(key_hash)
+                if slot is None:
+                    tokens, allowed, rejected = capacity, 0, 0
+                else:
+                    tokens = _refill(slot[1], slot[2], now, capacity, rate)
+                    allowed, rejected = slot[3], slot[4]
+                if tokens >= 1:
+                    tokens -= 1
+                    allowed = min(allowed + 1, 0xFFFFFFFF)
+                    wait = 0
+                else:
+                    rejected = min(rejected + 1, 0xFFFFFFFF)
+                    wait = (1 - tokens) / rate
+                self.SLOT.pack_into(self._map, offset, key_hash, tokens, now, allowed, rejected,
+                                    name.encode()[:32])
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return wait
+
+    def stats(self, limit=20):
+        with self._lock:
+            self._open()
+            rows = []
+            for offset in range(0, self.slots * self.SLOT.size, self.SLOT.size):
+                key_hash, tokens, _, allowed, rejected, name = self.SLOT.unpack_from(self._map, offset)
+                if key_hash:
+                    rows.append({'key': name.rstrip(b'\0').decode(errors='replace'), 'allowed': allowed,
+                                 'rejected': rejected, 'tokens': round(tokens, 2)})
+        return sorted(rows, key=lambda row: (-row['rejected'], -row['allowed']))[:limit]
+
+
+class RedisRateLimiter:
+    """Корзина - хэш в Redis, пересчет и списание атомарно в одном Lua-скрипте."""
+
+    remote = True  # сетевой вызов: ASGI-режим выполняет его в пуле потоков
+
+    SCRIPT = '''
+local capacity, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    redis.call('HINCRBY', KEYS[1], 'allowed', 1)
+else
+    wait = (1 - tokens) / rate
+    redis.call('HINCRBY', KEYS[1], 'rejected', 1)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+'''
+
+    def __init__(self, url, rules, prefix='skyid:ratelimit:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('Redis rate limiting requires: pip install redis')
+        self._redis = redis.Redis.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+        self.rules = rules
+        self.prefix = prefix
+
+    def hit(self, rule, key):
+        capacity, rate = self.rules[rule]
+        return float(self._script(keys=[f'{self.prefix}{rule}:{key}'], args=[capacity, rate, repr(time.time())]))
+
+    def stats(self, limit=20):
+        rows = []
+        for name in self._redis.scan_iter(self.prefix + '*'):
+            bucket = self._redis.hgetall(name)
+            rows.append({'key': name.decode()[len(self.prefix):], 'allowed': int(bucket.get(b'allowed', 0)),
+                         'rejected': int(bucket.get(b'rejected', 0)),
+                         'tokens': round(float(bucket.get(b'tokens', 0)), 2)})
+        return sorted(rows, key=lambda row: (-row['rejected'], -row['allowed']))[:limit]
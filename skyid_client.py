@@ -0,0 +1,494 @@
+"""Клиент SkyID для сервисов-потребителей (relying party).
+
+Модуль не зависит от остального кода сервера - его можно просто положить в свой
+проект. Нужен httpx; если установлен cryptography, подписанные токены (EdDSA)
+проверяются на месте по ключам из /.well-known/jwks.json, без запроса к
+/oauth/userinfo.
+
+    client = SkyIDClient('https://id.skymonder.ru', CLIENT_ID, API_KEY,
+                         redirect_uri='https://app.example/callback')
+
+    verifier = generate_code_verifier()          # сохранить в сессии вместе со state
+    url = client.authorization_url(state=state, code_verifier=verifier)
+    # ... пользователь вернулся на redirect_uri с ?code=...
+    token = client.exchange_code(code, code_verifier=verifier)
+    profile = client.userinfo(token['access_token'])
+
+AsyncSkyIDClient - то же для asyncio (await client.exchange_code(...)).
+
+  - соединения: у клиента один пул keep-alive соединений, поэтому клиент создается
+    один раз на процесс, а не на запрос;
+  - кеш: профиль - до истечения токена (exp или expires_in), JWKS и discovery -
+    на время из Cache-Control;
+  - повторы: ошибки соединения, 429 и 5xx повторяются с экспоненциальной паузой со
+    случайной составляющей (или по Retry-After). Код авторизации одноразовый,
+    поэтому обмен кода повторяется только если запрос точно не дошел до сервера
+    или был отклонен ограничителем частоты (429).
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import httpx
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+except ImportError:  # pragma: no cover - без cryptography токены проверяет сервер
+    Ed25519PublicKey = None
+
+DEFAULT_SCOPE = 'openid profile'
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Запрос с такой ошибкой до сервера не дошел - его можно повторить даже для обмена кода
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Как часто можно перечитывать JWKS, встретив неизвестный kid (как KeySet на сервере)
+JWKS_RELOAD_THROTTLE = 30
+
+
+class SkyIDError(Exception):
+
+    def __init__(self, error, description=None, status=None):
+        super().__init__(f'{error}: {description}' if description else error)
+        self.error = error
+        self.description = description
+        self.status = status
+
+
+class InvalidToken(SkyIDError):
+
+    def __init__(self, description):
+        super().__init__('invalid_token', description, 401)
+
+
+# --- ВСПОМОГАТЕЛЬНОЕ ---
+
+def _b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64url_decode(data):
+    data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def generate_code_verifier():
+    """Секрет PKCE: 64 символа из [A-Za-z0-9_-]."""
+    return secrets.token_urlsafe(48)
+
+
+def code_challenge(verifier):
+    return _b64url_encode(hashlib.sha256(verifier.encode('ascii')).digest())
+
+
+def backoff(attempt, base, cap):
+    # Случайная составляющая разводит повторы клиентов, получивших ошибку одновременно
+    return random.uniform(0.5, 1.0) * min(cap, base * 2 ** attempt)
+
+
+def is_jwt(token):
+    return token.count('.') == 2
+
+
+def _token_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _max_age(response, default):
+    for directive in response.headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age' and value.isdigit():
+            return int(value)
+    return default
+
+
+def _retry_after(response):
+    value = response.headers.get('retry-after', '')
+    return int(value) if value.isdigit() else None
+
+
+def _payload(response):
+    """JSON ответа; ответ с ошибкой превращается в SkyIDError."""
+    try:
+        payload = response.json()
+    except ValueError:
+        payload = None
+    if response.status_code < 400 and isinstance(payload, dict):
+        return payload
+    if not isinstance(payload, dict):
+        payload = {}
+    error = payload.get('error') or f'http_{response.status_code}'
+    description = payload.get('error_description') or payload.get('message')
+    if response.status_code == 401 and error in ('invalid_token', 'unauthorized'):
+        raise InvalidToken(description)
+    raise SkyIDError(error, description, response.status_code)
+
+
+def _parse_jwt(token):
+    try:
+        header_b64, payload_b64, signature_b64 = token.split('.')
+        header = json.loads(_b64url_decode(header_b64))
+        claims = json.loads(_b64url_decode(payload_b64))
+        signature = _b64url_decode(signature_b64)
+    except (ValueError, TypeError):
+        raise InvalidToken('malformed token')
+    if not isinstance(header, dict) or header.get('alg') != 'EdDSA' or not isinstance(header.get('kid'), str):
+        raise InvalidToken('unsupported algorithm or missing key id')
+    if not isinstance(claims, dict) or not isinstance(claims.get('exp'), int):
+        raise InvalidToken('missing exp')
+    return header['kid'], (header_b64 + '.' + payload_b64).encode('ascii'), signature, claims
+
+
+def _profile(claims):
+    # Тот же ответ, что отдает /oauth/userinfo
+    return {
+        'sub': claims['sub'],
+        'id': int(claims['sub']),
+        'unique_identifier': claims['preferred_username'],
+        'name': claims['name'],
+        'preferred_username': claims['preferred_username'],
+    }
+
+
+class _TTLCache:
+    """LRU, у каждой записи свой срок жизни."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl):
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# --- ОБЩАЯ ЛОГИКА ---
+# Все, кроме сетевых вызовов: их синхронный и асинхронный клиенты делают по-своему
+
+class _BaseClient:
+
+    def __init__(self, base_url, client_id, client_secret, redirect_uri=None, timeout=10.0, retries=3,
+                 backoff_base=0.1, backoff_cap=5.0, max_connections=20, cache_size=10000, userinfo_ttl=300,
+                 verify_locally=True, leeway=30):
+        self.base_url = base_url.rstrip('/')
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.userinfo_ttl = userinfo_ttl  # для непрозрачных токенов, срок которых неизвестен
+        self.verify_locally = verify_locally and Ed25519PublicKey is not None
+        self.leeway = leeway
+        self._cache = _TTLCache(cache_size)
+        self._keys = {}             # kid -> Ed25519PublicKey
+        self._keys_expire_at = 0
+        self._keys_loaded_at = 0
+        self.requests = self.retried = self.verified_locally = 0
+        self._http_options = {
+            'base_url': self.base_url,
+            'timeout': timeout,
+            'follow_redirects': False,
+            'limits': httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                   keepalive_expiry=30),
+            'headers': {'User-Agent': 'SkyID-Client/1.0', 'Accept': 'application/json'},
+        }
+
+    def authorization_url(self, state=None, scope=DEFAULT_SCOPE, nonce=None, code_verifier=None, prompt=None,
+                          redirect_uri=None):
+        """Адрес страницы входа и согласия; запросов к серверу не делает."""
+        params = {'client_id': self.client_id, 'response_type': 'code'}
+        if scope:
+            params['scope'] = scope
+        if redirect_uri or self.redirect_uri:
+            params['redirect_uri'] = redirect_uri or self.redirect_uri
+        if state:
+            params['state'] = state
+        if nonce:
+            params['nonce'] = nonce
+        if code_verifier:
+            params['code_challenge'] = code_challenge(code_verifier)
+            params['code_challenge_method'] = 'S256'
+        if prompt:
+            params['prompt'] = prompt
+        return f'{self.base_url}/oauth/authorize?{urlencode(params)}'
+
+    def _token_form(self, code, code_verifier, redirect_uri):
+        form = {'grant_type': 'authorization_code', 'code': code}
+        if redirect_uri or self.redirect_uri:
+            form['redirect_uri'] = redirect_uri or self.redirect_uri
+        if code_verifier:
+            form['code_verifier'] = code_verifier
+        return form
+
+    def _token_issued(self, response):
+        token = _payload(response)
+        token['expires_at'] = int(time.time()) + token.get('expires_in', 0)
+        # Срок непрозрачного токена больше нигде не узнать - запоминаем для кеша профиля
+        self._cache.set(('expires_at', _token_key(token['access_token'])), token['expires_at'],
+                        token.get('expires_in', 0))
+        return token
+
+    def _userinfo_ttl(self, key):
+        expires_at = self._cache.get(('expires_at', key))
+        return expires_at - time.time() if expires_at else self.userinfo_ttl
+
+    def _retry_delay(self, attempt, response=None):
+        retry_after = _retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_cap)
+        return backoff(attempt, self.backoff_base, self.backoff_cap)
+
+    def _should_retry(self, attempt, idempotent, response=None, error=None):
+        if attempt >= self.retries:
+            return False
+        if error is not None:
+            return idempotent or isinstance(error, NOT_SENT_ERRORS)
+        # 429 отдает ограничитель частоты до обработки запроса, код при этом не сгорает
+        return response.status_code in RETRY_STATUSES if idempotent else response.status_code == 429
+
+    def _keys_stale(self, kid):
+        now = time.time()
+        if now >= self._keys_expire_at:
+            return True
+        return kid not in self._keys and now - self._keys_loaded_at >= JWKS_RELOAD_THROTTLE
+
+    def _store_keys(self, response):
+        keys = {}
+        for jwk in _payload(response).get('keys', []):
+            if jwk.get('kty') == 'OKP' and jwk.get('crv') == 'Ed25519' and jwk.get('kid'):
+                keys[jwk['kid']] = Ed25519PublicKey.from_public_bytes(_b64url_decode(jwk['x']))
+        self._keys = keys
+        self._keys_loaded_at = time.time()
+        self._keys_expire_at = self._keys_loaded_at + _max_age(response, 3600)
+
+    def _check_jwt(self, parsed, public_key, issuer, audience=None, nonce=None):
+        kid, signing_input, signature, claims = parsed
+        if public_key is None:
+            raise InvalidToken('unknown key id')
+        try:
+            public_key.verify(signature, signing_input)
+        except InvalidSignature:
+            raise InvalidToken('bad signature')
+        if claims['exp'] + self.leeway < time.time():
+            raise InvalidToken('token expired')
+        if claims.get('iss') != issuer:
+            raise InvalidToken('wrong issuer')
+        if audience is None:
+            if 'client_id' not in claims:
+                raise InvalidToken('not an access token')
+            # Подпись у всех токенов SkyID общая: чужой токен прошел бы проверку выше
+            if claims['client_id'] != self.client_id:
+                raise InvalidToken('token issued to another client')
+        elif claims.get('aud') != audience:
+            raise InvalidToken('wrong audience')
+        if nonce is not None and claims.get('nonce') != nonce:
+            raise InvalidToken('nonce mismatch')
+        self.verified_locally += 1
+        return claims
+
+    def stats(self):
+        return {'requests': self.requests, 'retried': self.retried, 'verified_locally': self.verified_locally,
+                'cache_hits': self._cache.hits, 'cache_misses': self._cache.misses}
+
+
+# --- СИНХРОННЫЙ КЛИЕНТ ---
+
+class SkyIDClient(_BaseClient):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._http = httpx.Client(**self._http_options)
+        self._refresh_lock = threading.Lock()  # discovery и JWKS качает один поток, остальные ждут
+
+    def _request(self, method, path, idempotent=True, **kwargs):
+        attempt = 0
+        while True:
+            self.requests += 1
+            try:
+                response = self._http.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                if not self._should_retry(attempt, idempotent, error=e):
+                    raise SkyIDError('connection_error', f'{type(e).__name__}: {e}') from e
+                delay = self._retry_delay(attempt)
+            else:
+                if not self._should_retry(attempt, idempotent, response=response):
+                    return response
+                delay = self._retry_delay(attempt, response)
+            attempt += 1
+            self.retried += 1
+            time.sleep(delay)
+
+    def discovery(self):
+        document = self._cache.get('discovery')
+        if document is None:
+            with self._refresh_lock:
+                document = self._cache.get('discovery')
+                if document is None:
+                    response = self._request('GET', '/.well-known/openid-configuration')
+                    document = _payload(response)
+                    self._cache.set('discovery', document, _max_age(response, 3600))
+        return document
+
+    def exchange_code(self, code, code_verifier=None, redirect_uri=None):
+        """Обменивает код на токены; к ответу сервера добавляется expires_at."""
+        response = self._request('POST', '/oauth/token', idempotent=False,
+                                 data=self._token_form(code, code_verifier, redirect_uri),
+                                 auth=(self.client_id, self.client_secret))
+        return self._token_issued(response)
+
+    def _public_key(self, kid):
+        if self._keys_stale(kid):
+            with self._refresh_lock:
+                if self._keys_stale(kid):
+                    self._store_keys(self._request('GET', '/.well-known/jwks.json'))
+        return self._keys.get(kid)
+
+    def verify_token(self, token, audience=None, nonce=None):
+        """Проверяет подпись, срок и издателя токена на месте, возвращает claims.
+
+        Без audience - access-токен этого приложения (client_id), с audience=client_id -
+        его id_token.
+        """
+        if Ed25519PublicKey is None:
+            raise RuntimeError('Local token verification requires: pip install cryptography')
+        parsed = _parse_jwt(token)
+        return self._check_jwt(parsed, self._public_key(parsed[0]), self.discovery()['issuer'], audience, nonce)
+
+    def verify_id_token(self, id_token, nonce=None):
+        return self.verify_token(id_token, audience=self.client_id, nonce=nonce)
+
+    def userinfo(self, access_token):
+        key = _token_key(access_token)
+        profile = self._cache.get(('userinfo', key))
+        if profile is not None:
+            return profile
+        if self.verify_locally and is_jwt(access_token):
+            claims = self.verify_token(access_token)
+            profile, ttl = _profile(claims), claims['exp'] - time.time()
+        else:
+            profile = _payload(self._request('GET', '/oauth/userinfo',
+                                             headers={'Authorization': f'Bearer {access_token}'}))
+            ttl = self._userinfo_ttl(key)
+        self._cache.set(('userinfo', key), profile, ttl)
+        return profile
+
+    def close(self):
+        self._http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# --- АСИНХРОННЫЙ КЛИЕНТ ---
+
+class AsyncSkyIDClient(_BaseClient):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._http = httpx.AsyncClient(**self._http_options)
+        self._refresh_lock = asyncio.Lock()
+
+    async def _request(self, method, path, idempotent=True, **kwargs):
+        attempt = 0
+        while True:
+            self.requests += 1
+            try:
+                response = await self._http.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                if not self._should_retry(attempt, idempotent, error=e):
+                    raise SkyIDError('connection_error', f'{type(e).__name__}: {e}') from e
+                delay = self._retry_delay(attempt)
+            else:
+                if not self._should_retry(attempt, idempotent, response=response):
+                    return response
+                delay = self._retry_delay(attempt, response)
+            attempt += 1
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    async def discovery(self):
+        document = self._cache.get('discovery')
+        if document is None:
+            async with self._refresh_lock:
+                document = self._cache.get('discovery')
+                if document is None:
+                    response = await self._request('GET', '/.well-known/openid-configuration')
+                    document = _payload(response)
+                    self._cache.set('discovery', document, _max_age(response, 3600))
+        return document
+
+    async def exchange_code(self, code, code_verifier=None, redirect_uri=None):
+        response = await self._request('POST', '/oauth/token', idempotent=False,
+                                       data=self._token_form(code, code_verifier, redirect_uri),
+                                       auth=(self.client_id, self.client_secret))
+        return self._token_issued(response)
+
+    async def _public_key(self, kid):
+        if self._keys_stale(kid):
+            async with self._refresh_lock:
+                if self._keys_stale(kid):
+                    self._store_keys(await self._request('GET', '/.well-known/jwks.json'))
+        return self._keys.get(kid)
+
+    async def verify_token(self, token, audience=None, nonce=None):
+        if Ed25519PublicKey is None:
+            raise RuntimeError('Local token verification requires: pip install cryptography')
+        parsed = _parse_jwt(token)
+        public_key = await self._public_key(parsed[0])
+        return self._check_jwt(parsed, public_key, (await self.discovery())['issuer'], audience, nonce)
+
+    async def verify_id_token(self, id_token, nonce=None):
+        return await self.verify_token(id_token, audience=self.client_id, nonce=nonce)
+
+    async def userinfo(self, access_token):
+        key = _token_key(access_token)
+        profile = self._cache.get(('userinfo', key))
+        if profile is not None:
+            return profile
+        if self.verify_locally and is_jwt(access_token):
+            claims = await self.verify_token(access_token)
+            profile, ttl = _profile(claims), claims['exp'] - time.time()
+        else:
+            profile = _payload(await self._request('GET', '/oauth/userinfo',
+                                                   headers={'Authorization': f'Bearer {access_token}'}))
+            ttl = self._userinfo_ttl(key)
+        self._cache.set(('userinfo', key), profile, ttl)
+        return profile
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
@@ -0,0 +1,828 @@
+"""Слой хранения SkyID: пользователи, приложения, коды авторизации, токены.
+
+Маршруты работают только с интерфейсом Storage, конкретная СУБД выбирается
+при старте:
+  - SQLiteStorage   - локальный файл skyid.db (по умолчанию, один хост);
+  - PostgresStorage - PostgreSQL для нескольких узлов за балансировщиком.
+    Нужен пакет psycopg 3 с пулом: pip install "psycopg[binary,pool]".
+    psycopg 3 умеет и асинхронный режим, поэтому драйвер подойдет и для ASGI.
+
+Каждый метод - отдельная короткая транзакция. Строки возвращаются словарями.
+
+Схема версионируется: MIGRATIONS диалекта - список шагов, номер шага - версия,
+примененная версия хранится в таблице schema_version. migrate() применяет
+недостающие шаги (по одному, каждый в своей транзакции, под блокировкой от
+параллельного запуска), schema_version() только читает номер.
+"""
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+
+class IntegrityError(Exception):
+    """Нарушение уникальности (занятый логин, повтор кода и т.п.)."""
+
+
+class Storage:
+    """Контракт хранилища. Реализации переопределяют все методы."""
+
+    # Схема
+    def latest_version(self):
+        raise NotImplementedError
+
+    def schema_version(self):
+        raise NotImplementedError
+
+    def migrate(self):
+        """Применяет недостающие миграции, возвращает номера примененных."""
+        raise NotImplementedError
+
+    # Пользователи
+    def create_user(self, username, password_hash, name):
+        raise NotImplementedError
+
+    def get_user(self, user_id):
+        raise NotImplementedError
+
+    def get_user_by_username(self, username):
+        raise NotImplementedError
+
+    def update_password(self, user_id, password_hash):
+        raise NotImplementedError
+
+    # Приложения
+    def create_app(self, client_id, api_key, owner_id, app_name, redirect_uri):
+        raise NotImplementedError
+
+    def get_app(self, client_id):
+        raise NotImplementedError
+
+    def list_apps(self, owner_id, after=None, limit=20):
+        """Страница приложений владельца по возрастанию client_id, начиная после after."""
+        raise NotImplementedError
+
+    # Коды авторизации (при SKYID_AUTH_CODE_STORE=sql, см. codestore.py)
+    def save_auth_code(self, code, user_id, client_id, scope=None, nonce=None, redirect_uri=None,
+                       code_challenge=None, code_challenge_method=None):
+        raise NotImplementedError
+
+    def take_auth_code(self, code, client_id, max_age):
+        """Атомарно забирает код (не старше max_age секунд); повторный вызов вернет None."""
+        raise NotImplementedError
+
+    def count_auth_codes(self):
+        raise NotImplementedError
+
+    # Разрешения (пользователь дал приложению доступ к профилю)
+    def save_grant(self, user_id, client_id, scope, granted_at, webhook_event=None):
+        """webhook_event - (тип, данные): событие для вебхука приложения, если он настроен;
+        пишется в webhook_outbox той же транзакцией."""
+        raise NotImplementedError
+
+    def get_grant(self, user_id, client_id):
+        raise NotImplementedError
+
+    def list_grants(self, user_id, limit=100):
+        """Разрешения пользователя с названиями приложений, новые первыми."""
+        raise NotImplementedError
+
+    def delete_grant(self, user_id, client_id, webhook_event=None):
+        """Отзывает разрешение; True, если оно было."""
+        raise NotImplementedError
+
+    def get_granted_users(self, client_id, user_ids):
+        """Профили тех из user_ids, кто дал доступ приложению client_id."""
+        raise NotImplementedError
+
+    def list_granted_users(self, client_id, after=None, limit=1000):
+        """Страница профилей пользователей приложения по возрастанию id, начиная после after."""
+        raise NotImplementedError
+
+    # Непрозрачные access-токены
+    def save_access_token(self, token_hash, user_id, client_id, issued_at, expires_at):
+        raise NotImplementedError
+
+    def get_access_token(self, token_hash, now):
+        raise NotImplementedError
+
+    def delete_access_token(self, token_hash, client_id):
+        raise NotImplementedError
+
+    # Ключи подписи
+    def load_signing_keys(self):
+        raise NotImplementedError
+
+    def save_signing_key(self, kid, private_key, created_at, prune_before):
+        raise NotImplementedError
+
+    # Вебхуки приложений: адрес, секрет и очередь доставки (webhook_outbox)
+    def set_webhook(self, client_id, url, secret):
+        raise NotImplementedError
+
+    def claim_webhooks(self, now, lease, limit):
+        """Забирает до limit созревших событий и откладывает их на lease секунд: другой
+        диспетчер их не возьмет, а события упавшего вернутся в очередь сами."""
+        raise NotImplementedError
+
+    def finish_webhooks(self, delivered_ids, retries, dead):
+        """Итог доставки: доставленные удаляются; retries - (attempts, next_attempt_at, error, id),
+        dead - (attempts, error, id) - остаются в таблице со статусом dead."""
+        raise NotImplementedError
+
+    def webhook_stats(self):
+        raise NotImplementedError
+
+    def retry_dead_webhooks(self, now, client_id=None):
+        raise NotImplementedError
+
+    # Журнал аудита (только добавление)
+    def save_audit_events(self, rows):
+        """rows - кортежи (ts, event, user_id, client_id, ip, details); вся пачка - одна транзакция."""
+        raise NotImplementedError
+
+    def iter_audit_events(self, event=None, user_id=None, client_id=None, since=None, until=None,
+                          batch_size=5000):
+        """События по возрастанию id; ts в секундах Unix, since включительно, until - нет."""
+        raise NotImplementedError
+
+    # Массовый перенос (flask import-data / export-data)
+    def import_users(self, rows, keep_ids=False):
+        """Пачка (username, password_hash, name) - или (id, ...) при keep_ids - одной
+        транзакцией; занятые логины пропускаются. Возвращает число вставленных."""
+        raise NotImplementedError
+
+    def import_apps(self, rows):
+        """Пачка (client_id, api_key, owner_id, app_name, redirect_uri); существующие пропускаются."""
+        raise NotImplementedError
+
+    def export_rows(self, table, batch_size=5000):
+        """Строки users или apps в порядке ключа; читаются с сервера пачками по batch_size."""
+        raise NotImplementedError
+
+    # Обслуживание
+    def sweep_expired(self, code_max_age, batch_size):
+        raise NotImplementedError
+
+
+class SQLStorage(Storage):
+    """Общая SQL-реализация; диалекты переопределяют DDL и расходящиеся запросы.
+
+    Запросы пишутся с плейсхолдером '?', для драйверов с '%s' он заменяется.
+    Тексты горячих запросов постоянны, поэтому драйвер кеширует их подготовку.
+    """
+
+    PLACEHOLDER = '?'
+    MIGRATIONS = ()
+    SQL_HAS_VERSION_TABLE = None
+    # Размер пачки для IN (...): не больше 999 параметров - предел старых сборок SQLite
+    IN_CHUNK_SIZE = 500
+
+    EXPORT_QUERIES = {
+        'users': 'SELECT id, username, password AS password_hash, name FROM users ORDER BY id',
+        'apps': 'SELECT client_id, api_key, owner_id, app_name, redirect_uri FROM apps ORDER BY client_id',
+    }
+
+    SQL_APP_BY_CLIENT_ID = 'SELECT * FROM apps WHERE client_id = ?'
+    SQL_ENQUEUE_WEBHOOK = ('INSERT INTO webhook_outbox (client_id, event, payload, created_at, next_attempt_at) '
+                           'SELECT client_id, ?, ?, ?, ? FROM apps WHERE client_id = ? AND webhook_url IS NOT NULL')
+    SQL_ACCESS_TOKEN = '''SELECT t.user_id, t.client_id, t.issued_at, t.expires_at, u.name, u.username
+                          FROM access_tokens t JOIN users u ON u.id = t.user_id
+                          WHERE t.token_hash = ? AND t.expires_at >= ?'''
+
+    @contextmanager
+    def connection(self):
+        raise NotImplementedError
+
+    def _sql(self, sql):
+        return sql if self.PLACEHOLDER == '?' else sql.replace('?', self.PLACEHOLDER)
+
+    def _one(self, sql, params=()):
+        with self.connection() as db:
+            row = db.execute(self._sql(sql), params).fetchone()
+        return dict(row) if row is not None else None
+
+    def _all(self, sql, params=()):
+        with self.connection() as db:
+            return [dict(row) for row in db.execute(self._sql(sql), params).fetchall()]
+
+    def _write(self, sql, params=()):
+        with self.connection() as db:
+            count = db.execute(self._sql(sql), params).rowcount
+            db.commit()
+        return count
+
+    def latest_version(self):
+        return len(self.MIGRATIONS)
+
+    def schema_version(self):
+        with self.connection() as db:
+            if db.execute(self.SQL_HAS_VERSION_TABLE).fetchone()['name'] is None:
+                db.rollback()
+                return 0
+            version = db.execute('SELECT MAX(version) AS version FROM schema_version').fetchone()['version']
+            db.rollback()
+        return version or 0
+
+    def _lock_for_migration(self, db):
+        raise NotImplementedError
+
+    def migrate(self):
+        applied = []
+        with self.connection() as db:
+            while True:
+                # Блокировка и повторное чтение версии: миграции могут одновременно
+                # запустить несколько воркеров или узлов
+                self._lock_for_migration(db)
+                db.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, '
+                           'applied_at INTEGER NOT NULL)')
+                version = db.execute('SELECT MAX(version) AS version FROM schema_version').fetchone()['version'] or 0
+                if version >= len(self.MIGRATIONS):
+                    db.commit()
+                    return applied
+                for statement in self.MIGRATIONS[version]:
+                    db.execute(statement)
+                db.execute(self._sql('INSERT INTO schema_version (version, applied_at) VALUES (?, ?)'),
+                           (version + 1, int(time.time())))
+                db.commit()
+                applied.append(version + 1)
+
+    def get_user(self, user_id):
+        return self._one('SELECT id, username, name FROM users WHERE id = ?', (user_id,))
+
+    def get_user_by_username(self, username):
+        return self._one('SELECT * FROM users WHERE username = ?', (username,))
+
+    def update_password(self, user_id, password_hash):
+        self._write('UPDATE users SET password = ? WHERE id = ?', (password_hash, user_id))
+
+    def create_app(self, client_id, api_key, owner_id, app_name, redirect_uri):
+        self._write('INSERT INTO apps (client_id, api_key, owner_id, app_name, redirect_uri) VALUES (?, ?, ?, ?, ?)',
+                    (client_id, api_key, owner_id, app_name, redirect_uri))
+
+    def get_app(self, client_id):
+        return self._one(self.SQL_APP_BY_CLIENT_ID, (client_id,))
+
+    def list_apps(self, owner_id, after=None, limit=20):
+        # Keyset-пагинация по индексу (owner_id, client_id): страница не дороже первой
+        if after is None:
+            return self._all('SELECT * FROM apps WHERE owner_id = ? ORDER BY client_id LIMIT ?', (owner_id, limit))
+        return self._all('SELECT * FROM apps WHERE owner_id = ? AND client_id > ? ORDER BY client_id LIMIT ?',
+                         (owner_id, after, limit))
+
+    def save_auth_code(self, code, user_id, client_id, scope=None, nonce=None, redirect_uri=None,
+                       code_challenge=None, code_challenge_method=None):
+        self._write('INSERT INTO auth_codes (code, user_id, client_id, scope, nonce, redirect_uri, code_challenge, '
+                    'code_challenge_method) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (code, user_id, client_id, scope, nonce, redirect_uri, code_challenge, code_challenge_method))
+
+    def count_auth_codes(self):
+        return self._one('SELECT COUNT(*) AS count FROM auth_codes')['count']
+
+    def save_grant(self, user_id, client_id, scope, granted_at, webhook_event=None):
+        with self.connection() as db:
+            db.execute(self._sql('INSERT INTO grants (user_id, client_id, scope, granted_at) VALUES (?, ?, ?, ?) '
+                                 'ON CONFLICT (user_id, client_id) DO UPDATE SET scope = excluded.scope, '
+                                 'granted_at = excluded.granted_at'), (user_id, client_id, scope, granted_at))
+            if webhook_event:
+                self._enqueue_webhook(db, client_id, webhook_event)
+            db.commit()
+
+    def get_grant(self, user_id, client_id):
+        return self._one('SELECT * FROM grants WHERE user_id = ? AND client_id = ?', (user_id, client_id))
+
+    def list_grants(self, user_id, limit=100):
+        return self._all('SELECT g.client_id, g.scope, g.granted_at, a.app_name FROM grants g '
+                         'LEFT JOIN apps a ON a.client_id = g.client_id WHERE g.user_id = ? '
+                         'ORDER BY g.granted_at DESC LIMIT ?', (user_id, limit))
+
+    def delete_grant(self, user_id, client_id, webhook_event=None):
+        with self.connection() as db:
+            deleted = db.execute(self._sql('DELETE FROM grants WHERE user_id = ? AND client_id = ?'),
+                                 (user_id, client_id)).rowcount
+            if deleted and webhook_event:
+                self._enqueue_webhook(db, client_id, webhook_event)
+            db.commit()
+        return deleted > 0
+
+    def _enqueue_webhook(self, db, client_id, webhook_event):
+        # INSERT ... SELECT: строка появится, только если у приложения задан адрес вебхука
+        event_type, data = webhook_event
+        now = time.time()
+        db.execute(self._sql(self.SQL_ENQUEUE_WEBHOOK), (event_type, json.dumps(data), int(now), now, client_id))
+
+    def set_webhook(self, client_id, url, secret):
+        self._write('UPDATE apps SET webhook_url = ?, webhook_secret = ? WHERE client_id = ?', (url, secret, client_id))
+
+    def finish_webhooks(self, delivered_ids, retries, dead):
+        with self.connection() as db:
+            cursor = db.cursor()
+            if delivered_ids:
+                cursor.executemany(self._sql('DELETE FROM webhook_outbox WHERE id = ?'), [(i,) for i in delivered_ids])
+            if retries:
+                cursor.executemany(self._sql('UPDATE webhook_outbox SET attempts = ?, next_attempt_at = ?, '
+                                             'last_error = ? WHERE id = ?'), retries)
+            if dead:
+                cursor.executemany(self._sql("UPDATE webhook_outbox SET attempts = ?, status = 'dead', "
+                                             "last_error = ? WHERE id = ?"), dead)
+            db.commit()
+
+    def webhook_stats(self):
+        return self._all('SELECT status, COUNT(*) AS count, MIN(next_attempt_at) AS next_attempt_at '
+                         'FROM webhook_outbox GROUP BY status ORDER BY status')
+
+    def retry_dead_webhooks(self, now, client_id=None):
+        if client_id is None:
+            return self._write("UPDATE webhook_outbox SET status = 'pending', attempts = 0, next_attempt_at = ? "
+                               "WHERE status = 'dead'", (now,))
+        return self._write("UPDATE webhook_outbox SET status = 'pending', attempts = 0, next_attempt_at = ? "
+                           "WHERE status = 'dead' AND client_id = ?", (now, client_id))
+
+    def get_granted_users(self, client_id, user_ids):
+        users = []
+        for start in range(0, len(user_ids), self.IN_CHUNK_SIZE):
+            chunk = user_ids[start:start + self.IN_CHUNK_SIZE]
+            users += self._all('SELECT u.id, u.username, u.name FROM grants g JOIN users u ON u.id = g.user_id '
+                               f"WHERE g.client_id = ? AND g.user_id IN ({', '.join('?' * len(chunk))})",
+                               (client_id, *chunk))
+        return users
+
+    def list_granted_users(self, client_id, after=None, limit=1000):
+        return self._all('SELECT u.id, u.username, u.name FROM grants g JOIN users u ON u.id = g.user_id '
+                         'WHERE g.client_id = ? AND g.user_id > ? ORDER BY g.user_id LIMIT ?',
+                         (client_id, after or 0, limit))
+
+    def save_access_token(self, token_hash, user_id, client_id, issued_at, expires_at):
+        self._write('INSERT INTO access_tokens (token_hash, user_id, client_id, issued_at, expires_at) '
+                    'VALUES (?, ?, ?, ?, ?)', (token_hash, user_id, client_id, issued_at, expires_at))
+
+    def get_access_token(self, token_hash, now):
+        return self._one(self.SQL_ACCESS_TOKEN, (token_hash, now))
+
+    def delete_access_token(self, token_hash, client_id):
+        self._write('DELETE FROM access_tokens WHERE token_hash = ? AND client_id = ?', (token_hash, client_id))
+
+    def load_signing_keys(self):
+        with self.connection() as db:
+            return [tuple(row) for row in db.execute('SELECT kid, private_key, created_at FROM signing_keys')]
+
+    def save_signing_key(self, kid, private_key, created_at, prune_before):
+        with self.connection() as db:
+            db.execute(self._sql('INSERT INTO signing_keys (kid, private_key, created_at) VALUES (?, ?, ?)'),
+                       (kid, private_key, created_at))
+            db.execute(self._sql('DELETE FROM signing_keys WHERE created_at < ?'), (prune_before,))
+            db.commit()
+
+    def _insert_many(self, sql, rows):
+        # Вся пачка - один executemany и один commit (один fsync) вместо commit на строку
+        with self.connection() as db:
+            cursor = db.cursor()
+            cursor.executemany(self._sql(sql), rows)
+            count = cursor.rowcount
+            db.commit()
+        return count
+
+    def save_audit_events(self, rows):
+        return self._insert_many('INSERT INTO audit_log (ts, event, user_id, client_id, ip, details) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def iter_audit_events(self, event=None, user_id=None, client_id=None, since=None, until=None,
+                          batch_size=5000):
+        conditions, params = ['id > ?'], []
+        for condition, value in (('event = ?', event), ('user_id = ?', user_id), ('client_id = ?', client_id),
+                                 ('ts >= ?', since), ('ts < ?', until)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        sql = f"SELECT * FROM audit_log WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+        # Постранично по id, а не одним курсором: журнал читается, пока в него пишут воркеры
+        after = 0
+        while True:
+            rows = self._all(sql, (after, *params, batch_size))
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            after = rows[-1]['id']
+
+    def import_users(self, rows, keep_ids=False):
+        if keep_ids:
+            return self._insert_many('INSERT INTO users (id, username, password, name) VALUES (?, ?, ?, ?) '
+                                     'ON CONFLICT DO NOTHING', rows)
+        return self._insert_many('INSERT INTO users (username, password, name) VALUES (?, ?, ?) '
+                                 'ON CONFLICT DO NOTHING', rows)
+
+    def import_apps(self, rows):
+        return self._insert_many('INSERT INTO apps (client_id, api_key, owner_id, app_name, redirect_uri) '
+                                 'VALUES (?, ?, ?, ?, ?) ON CONFLICT DO NOTHING', rows)
+
+    def export_rows(self, table, batch_size=5000):
+        with self.connection() as db:
+            cursor = db.execute(self.EXPORT_QUERIES[table])
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(row)
+
+    def _sweep(self, sql, arg, batch_size):
+        # Каждая пачка - отдельная транзакция, между пачками уступаем блокировку
+        removed = 0
+        with self.connection() as db:
+            while True:
+                count = db.execute(self._sql(sql), (arg, batch_size)).rowcount
+                db.commit()
+                removed += count
+                if count < batch_size:
+                    return removed
+                time.sleep(0.01)
+
+
+# --- SQLITE ---
+
+class SQLiteStorage(SQLStorage):
+
+    MIGRATIONS = (
+        # 1: исходная схема (IF NOT EXISTS - базы, созданные до миграций, принимаются как есть)
+        (
+            # Таблица users: только login (username) и пароль
+            '''CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                name TEXT NOT NULL
+            )''',
+            '''CREATE TABLE IF NOT EXISTS apps (
+                client_id TEXT PRIMARY KEY,
+                api_key TEXT NOT NULL,
+                owner_id INTEGER NOT NULL,
+                app_name TEXT NOT NULL,
+                redirect_uri TEXT NOT NULL
+            )''',
+            # Временные коды авторизации (CRITICAL FOR OAUTH)
+            '''CREATE TABLE IF NOT EXISTS auth_codes (
+                code TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                client_id TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )''',
+            # Непрозрачные access-токены; храним только SHA-256 от токена
+            '''CREATE TABLE IF NOT EXISTS access_tokens (
+                token_hash TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                client_id TEXT NOT NULL,
+                issued_at INTEGER NOT NULL,
+                expires_at INTEGER NOT NULL
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_access_tokens_expires_at ON access_tokens (expires_at)',
+            # Ключи подписи access-токенов (общие для всех воркеров)
+            '''CREATE TABLE IF NOT EXISTS signing_keys (
+                kid TEXT PRIMARY KEY,
+                private_key BLOB NOT NULL,
+                created_at INTEGER NOT NULL
+            )''',
+        ),
+        # 2: индексы горячих запросов. apps (owner_id, client_id) - выборка и пагинация
+        # дашборда; auth_codes (timestamp) - очистка (rowid входит в индекс, таблицу
+        # читать не нужно); auth_codes (client_id) - выборки кодов приложения
+        (
+            'CREATE INDEX IF NOT EXISTS idx_apps_owner_client ON apps (owner_id, client_id)',
+            'CREATE INDEX IF NOT EXISTS idx_auth_codes_client_id ON auth_codes (client_id)',
+            'CREATE INDEX IF NOT EXISTS idx_auth_codes_timestamp ON auth_codes (timestamp)',
+        ),
+        # 3: OpenID Connect - запрошенные scope и nonce едут вместе с кодом
+        (
+            'ALTER TABLE auth_codes ADD COLUMN scope TEXT',
+            'ALTER TABLE auth_codes ADD COLUMN nonce TEXT',
+        ),
+        # 4: разрешения пользователей приложениям. Индекс (client_id, user_id) - выборки
+        # пользователей приложения пачками и постранично
+        (
+            '''CREATE TABLE IF NOT EXISTS grants (
+                user_id INTEGER NOT NULL,
+                client_id TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                granted_at INTEGER NOT NULL,
+                PRIMARY KEY (user_id, client_id)
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_grants_client_user ON grants (client_id, user_id)',
+        ),
+        # 5: код привязан к redirect_uri и PKCE-параметрам запроса авторизации
+        (
+            'ALTER TABLE auth_codes ADD COLUMN redirect_uri TEXT',
+            'ALTER TABLE auth_codes ADD COLUMN code_challenge TEXT',
+            'ALTER TABLE auth_codes ADD COLUMN code_challenge_method TEXT',
+        ),
+        # 6: журнал аудита. Выгрузки - по времени или по пользователю
+        (
+            '''CREATE TABLE IF NOT EXISTS audit_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                event TEXT NOT NULL,
+                user_id INTEGER,
+                client_id TEXT,
+                ip TEXT,
+                details TEXT
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_audit_log_ts ON audit_log (ts)',
+            'CREATE INDEX IF NOT EXISTS idx_audit_log_user ON audit_log (user_id, id)',
+        ),
+        # 7: вебхуки приложений и очередь их доставки. Индекс - выборка созревших событий
+        (
+            'ALTER TABLE apps ADD COLUMN webhook_url TEXT',
+            'ALTER TABLE apps ADD COLUMN webhook_secret TEXT',
+            '''CREATE TABLE IF NOT EXISTS webhook_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_id TEXT NOT NULL,
+                event TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                last_error TEXT
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_webhook_outbox_due ON webhook_outbox (status, next_attempt_at)',
+        ),
+    )
+
+    SQL_HAS_VERSION_TABLE = "SELECT MAX(name) AS name FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+
+    SQL_AUTH_CODE = 'SELECT * FROM auth_codes WHERE code = ? AND client_id = ? AND timestamp >= ?'
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def connection(self):
+        return self.pool.connection()
+
+    def _lock_for_migration(self, db):
+        # Сразу берем блокировку записи: второй мигратор подождет busy_timeout
+        db.execute('BEGIN IMMEDIATE')
+
+    @staticmethod
+    def _cutoff(max_age):
+        # Формат совпадает с CURRENT_TIMESTAMP, поэтому сравнение строк корректно
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - max_age))
+
+    def create_user(self, username, password_hash, name):
+        try:
+            with self.connection() as db:
+                user_id = db.execute('INSERT INTO users (username, password, name) VALUES (?, ?, ?)',
+                                     (username, password_hash, name)).lastrowid
+                db.commit()
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(str(e))
+        return user_id
+
+    def save_auth_code(self, code, user_id, client_id, scope=None, nonce=None, redirect_uri=None,
+                       code_challenge=None, code_challenge_method=None):
+        try:
+            super().save_auth_code(code, user_id, client_id, scope, nonce, redirect_uri, code_challenge,
+                                   code_challenge_method)
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(str(e))
+
+    def take_auth_code(self, code, client_id, max_age):
+        with self.connection() as db:
+            row = db.execute(self.SQL_AUTH_CODE, (code, client_id, self._cutoff(max_age))).fetchone()
+            if row is None:
+                return None
+            # Если параллельный запрос успел удалить код раньше - код уже использован
+            deleted = db.execute('DELETE FROM auth_codes WHERE code = ?', (code,)).rowcount
+            db.commit()
+        return dict(row) if deleted else None
+
+    def claim_webhooks(self, now, lease, limit):
+        with self.connection() as db:
+            # Обычно очередь пуста: проверяем чтением, не занимая блокировку записи
+            if db.execute("SELECT 1 FROM webhook_outbox WHERE status = 'pending' AND next_attempt_at <= ? LIMIT 1",
+                          (now,)).fetchone() is None:
+                return []
+            db.execute('BEGIN IMMEDIATE')
+            rows = [dict(row) for row in db.execute(
+                "SELECT id, client_id, event, payload, created_at, attempts FROM webhook_outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?", (now, limit))]
+            db.executemany('UPDATE webhook_outbox SET next_attempt_at = ? WHERE id = ?',
+                           [(now + lease, row['id']) for row in rows])
+            db.commit()
+        return rows
+
+    def sweep_expired(self, code_max_age, batch_size):
+        return (
+            self._sweep('DELETE FROM auth_codes WHERE rowid IN '
+                        '(SELECT rowid FROM auth_codes WHERE timestamp < ? LIMIT ?)',
+                        self._cutoff(code_max_age), batch_size)
+            + self._sweep('DELETE FROM access_tokens WHERE token_hash IN '
+                          '(SELECT token_hash FROM access_tokens WHERE expires_at < ? LIMIT ?)',
+                          int(time.time()), batch_size)
+        )
+
+
+# --- POSTGRESQL ---
+
+class PostgresStorage(SQLStorage):
+
+    PLACEHOLDER = '%s'
+    MIGRATIONS = (
+        # 1: исходная схема
+        (
+            '''CREATE TABLE IF NOT EXISTS users (
+                id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                name TEXT NOT NULL
+            )''',
+            '''CREATE TABLE IF NOT EXISTS apps (
+                client_id TEXT PRIMARY KEY,
+                api_key TEXT NOT NULL,
+                owner_id BIGINT NOT NULL,
+                app_name TEXT NOT NULL,
+                redirect_uri TEXT NOT NULL
+            )''',
+            '''CREATE TABLE IF NOT EXISTS auth_codes (
+                code TEXT PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                client_id TEXT NOT NULL,
+                timestamp TIMESTAMPTZ NOT NULL DEFAULT now()
+            )''',
+            '''CREATE TABLE IF NOT EXISTS access_tokens (
+                token_hash TEXT PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                client_id TEXT NOT NULL,
+                issued_at BIGINT NOT NULL,
+                expires_at BIGINT NOT NULL
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_access_tokens_expires_at ON access_tokens (expires_at)',
+            '''CREATE TABLE IF NOT EXISTS signing_keys (
+                kid TEXT PRIMARY KEY,
+                private_key BYTEA NOT NULL,
+                created_at BIGINT NOT NULL
+            )''',
+        ),
+        # 2: индексы горячих запросов (см. SQLiteStorage). Миграция идет в транзакции,
+        # поэтому без CONCURRENTLY: на больших таблицах применять в окно обслуживания
+        (
+            'CREATE INDEX IF NOT EXISTS idx_apps_owner_client ON apps (owner_id, client_id)',
+            'CREATE INDEX IF NOT EXISTS idx_auth_codes_client_id ON auth_codes (client_id)',
+            'CREATE INDEX IF NOT EXISTS idx_auth_codes_timestamp ON auth_codes (timestamp)',
+        ),
+        # 3: OpenID Connect - запрошенные scope и nonce едут вместе с кодом
+        (
+            'ALTER TABLE auth_codes ADD COLUMN scope TEXT',
+            'ALTER TABLE auth_codes ADD COLUMN nonce TEXT',
+        ),
+        # 4: разрешения пользователей приложениям
+        (
+            '''CREATE TABLE IF NOT EXISTS grants (
+                user_id BIGINT NOT NULL,
+                client_id TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                granted_at BIGINT NOT NULL,
+                PRIMARY KEY (user_id, client_id)
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_grants_client_user ON grants (client_id, user_id)',
+        ),
+        # 5: код привязан к redirect_uri и PKCE-параметрам запроса авторизации
+        (
+            'ALTER TABLE auth_codes ADD COLUMN redirect_uri TEXT',
+            'ALTER TABLE auth_codes ADD COLUMN code_challenge TEXT',
+            'ALTER TABLE auth_codes ADD COLUMN code_challenge_method TEXT',
+        ),
+        # 6: журнал аудита
+        (
+            '''CREATE TABLE IF NOT EXISTS audit_log (
+                id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                ts DOUBLE PRECISION NOT NULL,
+                event TEXT NOT NULL,
+                user_id BIGINT,
+                client_id TEXT,
+                ip TEXT,
+                details JSONB
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_audit_log_ts ON audit_log (ts)',
+            'CREATE INDEX IF NOT EXISTS idx_audit_log_user ON audit_log (user_id, id)',
+        ),
+        # 7: вебхуки приложений
+        (
+            'ALTER TABLE apps ADD COLUMN webhook_url TEXT',
+            'ALTER TABLE apps ADD COLUMN webhook_secret TEXT',
+            '''CREATE TABLE IF NOT EXISTS webhook_outbox (
+                id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                client_id TEXT NOT NULL,
+                event TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at BIGINT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at DOUBLE PRECISION NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                last_error TEXT
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_webhook_outbox_due ON webhook_outbox (status, next_attempt_at)',
+        ),
+    )
+
+    SQL_HAS_VERSION_TABLE = "SELECT to_regclass('schema_version') AS name"
+    MIGRATION_LOCK_ID = 0x736b7969  # произвольная константа для pg_advisory_xact_lock
+
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=10.0):
+        try:
+            import psycopg
+            from psycopg.rows import dict_row
+            from psycopg_pool import ConnectionPool
+        except ImportError:
+            raise RuntimeError('PostgreSQL backend requires: pip install "psycopg[binary,pool]"')
+        self._errors = psycopg.errors
+        self._pool_factory = lambda: ConnectionPool(
+            dsn, min_size=min_size, max_size=max_size, timeout=timeout,
+            kwargs={'row_factory': dict_row, 'autocommit': False}, open=True)
+        self._pool = None
+        self._pool_pid = None
+
+    @contextmanager
+    def connection(self):
+        # Пул создается лениво в каждом процессе: сокеты родителя после fork не переиспользуем
+        if self._pool_pid != os.getpid():
+            self._pool = self._pool_factory()
+            self._pool_pid = os.getpid()
+        with self._pool.connection() as conn:
+            yield conn
+
+    def _lock_for_migration(self, db):
+        db.execute('SELECT pg_advisory_xact_lock(%s)', (self.MIGRATION_LOCK_ID,))
+
+    def create_user(self, username, password_hash, name):
+        try:
+            with self.connection() as db:
+                row = db.execute('INSERT INTO users (username, password, name) VALUES (%s, %s, %s) RETURNING id',
+                                 (username, password_hash, name)).fetchone()
+                db.commit()
+        except self._errors.UniqueViolation as e:
+            raise IntegrityError(str(e))
+        return row['id']
+
+    def save_auth_code(self, code, user_id, client_id, scope=None, nonce=None, redirect_uri=None,
+                       code_challenge=None, code_challenge_method=None):
+        try:
+            super().save_auth_code(code, user_id, client_id, scope, nonce, redirect_uri, code_challenge,
+                                   code_challenge_method)
+        except self._errors.UniqueViolation as e:
+            raise IntegrityError(str(e))
+
+    def take_auth_code(self, code, client_id, max_age):
+        # DELETE ... RETURNING забирает код атомарно одним запросом
+        with self.connection() as db:
+            row = db.execute('DELETE FROM auth_codes WHERE code = %s AND client_id = %s '
+                             'AND timestamp >= now() - make_interval(secs => %s) RETURNING *',
+                             (code, client_id, max_age)).fetchone()
+            db.commit()
+        return row
+
+    def get_granted_users(self, client_id, user_ids):
+        # Массив - один параметр: текст запроса постоянен при любом числе id
+        return self._all('SELECT u.id, u.username, u.name FROM grants g JOIN users u ON u.id = g.user_id '
+                         'WHERE g.client_id = ? AND g.user_id = ANY(?)', (client_id, list(user_ids)))
+
+    def import_users(self, rows, keep_ids=False):
+        count = super().import_users(rows, keep_ids)
+        if keep_ids:
+            # Явные id не двигают identity-последовательность: подтягиваем ее к максимуму,
+            # иначе следующая регистрация получит уже занятый id
+            self._one("SELECT setval(pg_get_serial_sequence('users', 'id'), MAX(id)) AS id FROM users")
+        return count
+
+    def export_rows(self, table, batch_size=5000):
+        # Именованный курсор живет на сервере: клиент получает строки пачками по batch_size
+        with self.connection() as db:
+            with db.cursor(name=f'skyid_export_{table}') as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(self.EXPORT_QUERIES[table])
+                yield from cursor
+            db.rollback()
+
+    def load_signing_keys(self):
+        with self.connection() as db:
+            return [(row['kid'], row['private_key'], row['created_at'])
+                    for row in db.execute('SELECT kid, private_key, created_at FROM signing_keys')]
+
+    def claim_webhooks(self, now, lease, limit):
+        # SKIP LOCKED: параллельные диспетчеры разбирают разные строки, не дожидаясь друг друга
+        with self.connection() as db:
+            rows = db.execute("UPDATE webhook_outbox SET next_attempt_at = %s WHERE id IN ("
+                              "SELECT id FROM webhook_outbox WHERE status = 'pending' AND next_attempt_at <= %s "
+                              "ORDER BY next_attempt_at LIMIT %s FOR UPDATE SKIP LOCKED) "
+                              "RETURNING id, client_id, event, payload, created_at, attempts",
+                              (now + lease, now, limit)).fetchall()
+            db.commit()
+        return rows
+
+    def sweep_expired(self, code_max_age, batch_size):
+        return (
+            self._sweep('DELETE FROM auth_codes WHERE ctid = ANY(ARRAY('
+                        'SELECT ctid FROM auth_codes WHERE timestamp < now() - make_interval(secs => ?) LIMIT ?))',
+                        code_max_age, batch_size)
+            + self._sweep('DELETE FROM access_tokens WHERE ctid = ANY(ARRAY('
+                          'SELECT ctid FROM access_tokens WHERE expires_at < ? LIMIT ?))',
+                          int(time.time()), batch_size)
+        )
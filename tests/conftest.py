@@ -0,0 +1,18 @@
+import os
+
+import pytest
+
+# До импорта app.py: без фоновых потоков, общих файлов и /metrics
+os.environ.setdefault('SKYID_RATE_LIMIT_BACKEND', 'memory')
+os.environ.setdefault('SKYID_WEBHOOK_DISPATCHER', 'off')
+os.environ.setdefault('SKYID_AUDIT_BACKEND', 'off')
+os.environ.setdefault('SKYID_AUTH_CODE_STORE', 'sql')
+os.environ.setdefault('SKYID_METRICS', '0')
+
+
+@pytest.fixture(scope='session')
+def skyid(tmp_path_factory):
+    """Модуль app.py, импортированный в пустом каталоге: skyid.db и прочие файлы появятся там."""
+    os.chdir(tmp_path_factory.mktemp('skyid'))
+    import app
+    return app
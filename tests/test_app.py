@@ -0,0 +1,87 @@
+import base64
+import secrets
+
+import pytest
+
+
+@pytest.fixture
+def client_app(skyid):
+    """Приложение с секретом из не-ASCII символов: (client_id, api_key)."""
+    user_id = skyid.storage.create_user('owner-' + secrets.token_hex(4), 'hash', 'Owner')
+    client_id, api_key = str(secrets.randbelow(9 * 10 ** 9) + 10 ** 9), 'ключ-' + secrets.token_hex(16)
+    skyid.storage.create_app(client_id, api_key, user_id, 'Shop', 'http://rp/cb')
+    return client_id, api_key
+
+
+@pytest.fixture
+def http(skyid):
+    # Свой IP на тест: корзины ограничителя частоты не переходят из теста в тест
+    client = skyid.app.test_client()
+    client.environ_base['REMOTE_ADDR'] = f'10.0.{secrets.randbelow(256)}.{secrets.randbelow(256)}'
+    return client
+
+
+def basic(client_id, api_key):
+    return 'Basic ' + base64.b64encode(f'{client_id}:{api_key}'.encode()).decode()
+
+
+# --- УЧЕТНЫЕ ДАННЫЕ ПРИЛОЖЕНИЯ ---
+
+def test_client_credentials(skyid, client_app):
+    client_id, api_key = client_app
+    assert skyid.get_client_by_credentials(client_id, api_key)['client_id'] == client_id
+    assert skyid.get_client_by_credentials(client_id, api_key[:-1]) is None
+    assert skyid.get_client_by_credentials(client_id, 'секрет') is None
+    assert skyid.get_client_by_credentials('0', api_key) is None
+
+
+@pytest.mark.parametrize('path', ['/oauth/token', '/oauth/introspect'])
+def test_non_ascii_secret_is_rejected_not_crashing(http, client_app, path):
+    form = {'grant_type': 'authorization_code', 'client_id': client_app[0], 'client_secret': 'пароль',
+            'code': 'x', 'token': 'x'}
+    assert http.post(path, data=form).status_code == 401
+
+
+# --- ОГРАНИЧЕНИЕ ЧАСТОТЫ ---
+
+def test_rate_limit_keys(skyid):
+    keys = skyid.rate_limit_keys
+    assert keys('oauth_token', 'POST', '1.2.3.4', {'client_id': 'c1'}, None) == [('token:ip', '1.2.3.4'),
+                                                                              ('token:client', 'c1')]
+    assert keys('api_users_lookup', 'POST', '1.2.3.4', {'client_id': 'c1'}, None) == [('api:ip', '1.2.3.4'),
+                                                                                   ('api:client', 'c1')]
+    assert keys('api_users_export', 'GET', '1.2.3.4', {}, basic('c2', 'x')) == [('api:ip', '1.2.3.4'),
+                                                                             ('api:client', 'c2')]
+    # client_id из JSON может оказаться не строкой - остается только корзина IP
+    assert keys('api_users_lookup', 'POST', '1.2.3.4', {'client_id': [1]}, None) == [('api:ip', '1.2.3.4')]
+    assert keys('login', 'POST', '1.2.3.4', {'username': ' Alice '}, None) == [('login:ip', '1.2.3.4'),
+                                                                           ('login:user', 'alice')]
+    assert keys('login', 'GET', '1.2.3.4', {}, None) == []
+
+
+def test_json_credentials_are_rate_limited(http, client_app):
+    payload = {'client_id': client_app[0], 'client_secret': 'wrong', 'ids': [1]}
+    statuses = [http.post('/api/users/lookup', json=payload).status_code for _ in range(100)]
+    assert statuses[0] == 401
+    assert statuses.count(429) > 50
+    assert http.post('/api/users/lookup', json=payload).headers['Retry-After']
+
+
+# --- ПАКЕТНЫЙ ДОСТУП К ПРОФИЛЯМ ---
+
+@pytest.mark.parametrize('ids', [[1.5], [True], ['1'], [None], [[1]], 5, '1,x', [], '1,²'])
+def test_lookup_rejects_non_integer_ids(http, client_app, ids):
+    client_id, api_key = client_app
+    response = http.post('/api/users/lookup', json={'ids': ids}, headers={'Authorization': basic(client_id, api_key)})
+    assert response.status_code == 400
+
+
+def test_lookup_returns_granted_users(skyid, http, client_app):
+    client_id, api_key = client_app
+    user_id = skyid.storage.create_user('granted-' + secrets.token_hex(4), 'hash', 'Granted')
+    skyid.storage.save_grant(user_id, client_id, 'openid', 100)
+    for ids in ([user_id, user_id + 1000], f'{user_id},{user_id + 1000}'):
+        response = http.post('/api/users/lookup', json={'ids': ids}, headers={'Authorization': basic(client_id, api_key)})
+        assert response.status_code == 200
+        assert [u['id'] for u in response.get_json()['users']] == [user_id]
+        assert response.get_json()['not_found'] == [user_id + 1000]
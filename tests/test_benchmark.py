@@ -0,0 +1,16 @@
+import pytest
+
+from benchmark import percentile
+
+
+@pytest.mark.parametrize('values, pct, expected', [
+    (range(1, 101), 95, 95),
+    (range(1, 11), 50, 5),
+    (range(1, 21), 95, 19),
+    (range(1, 1001), 99.9, 999),
+    (range(1, 101), 100, 100),
+    ([7], 99, 7),
+    ([], 50, 0.0),
+])
+def test_nearest_rank_percentile(values, pct, expected):
+    assert percentile(list(values), pct) == expected
@@ -0,0 +1,30 @@
+import io
+import json
+
+import bulk
+
+
+def test_read_records_skips_malformed_jsonl_lines():
+    lines = ['{"username": "a1"}', '{bad json', '', '[1, 2]', '"text"', '{"username": "a2"}']
+    records = list(bulk.read_records(io.StringIO('\n'.join(lines) + '\n'), 'jsonl'))
+    assert [r['username'] for r in records if isinstance(r, dict)] == ['a1', 'a2']
+    assert [str(r) for r in records if isinstance(r, bulk.BadRecord)] == [
+        'строка 2: некорректный JSON (Expecting property name enclosed in double quotes)',
+        'строка 4: запись не является объектом',
+        'строка 5: запись не является объектом',
+    ]
+
+
+def test_import_counts_bad_lines_and_continues(skyid, tmp_path):
+    path = tmp_path / 'users.jsonl'
+    path.write_text('\n'.join([
+        json.dumps({'username': 'bulk-1', 'password': 'pw-1'}),
+        '{bad json',
+        json.dumps({'username': 'bulk-2', 'password_hash': 5}),
+        json.dumps({'username': 'bulk-3', 'password': 'pw-3'}),
+    ]) + '\n', encoding='utf-8')
+    result = skyid.app.test_cli_runner().invoke(args=['import-data', 'users', str(path)])
+    assert result.exit_code == 0, result.output
+    assert 'строка 2: некорректный JSON' in result.output
+    assert 'bulk-2: неизвестный формат password_hash' in result.output
+    assert skyid.storage.get_user_by_username('bulk-1') and skyid.storage.get_user_by_username('bulk-3')
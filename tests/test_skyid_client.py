@@ -0,0 +1,76 @@
+import time
+
+import httpx
+import pytest
+
+import tokens
+from skyid_client import InvalidToken, SkyIDClient
+
+ISSUER = 'https://id.example'
+CLIENT_ID = '1000000001'
+
+
+@pytest.fixture
+def keyset():
+    stored = []
+    keyset = tokens.KeySet(lambda: list(stored), lambda kid, raw, created_at, prune_before: stored.append(
+        (kid, raw, created_at)), rotation_interval=86400, token_ttl=3600)
+    keyset.rotate()
+    return keyset
+
+
+@pytest.fixture
+def client(keyset):
+    """Клиент, которому discovery и JWKS отдает MockTransport, а не сеть."""
+    def handler(request):
+        if request.url.path == '/.well-known/openid-configuration':
+            return httpx.Response(200, json={'issuer': ISSUER, 'jwks_uri': ISSUER + '/.well-known/jwks.json'})
+        if request.url.path == '/.well-known/jwks.json':
+            return httpx.Response(200, json=keyset.jwks())
+        return httpx.Response(404)
+
+    client = SkyIDClient(ISSUER, CLIENT_ID, 'secret')
+    client._http.close()
+    client._http = httpx.Client(base_url=ISSUER, transport=httpx.MockTransport(handler))
+    yield client
+    client.close()
+
+
+def token(keyset, **claims):
+    now = int(time.time())
+    return tokens.encode(dict({'iss': ISSUER, 'sub': '7', 'iat': now, 'exp': now + 600}, **claims), keyset)
+
+
+def test_access_token_of_this_client(client, keyset):
+    assert client.verify_token(token(keyset, client_id=CLIENT_ID))['sub'] == '7'
+
+
+def test_access_token_of_another_client_is_rejected(client, keyset):
+    with pytest.raises(InvalidToken, match='another client'):
+        client.verify_token(token(keyset, client_id='2000000002'))
+
+
+@pytest.mark.parametrize('claims, error', [
+    ({'client_id': CLIENT_ID, 'iss': 'https://evil.example'}, 'wrong issuer'),
+    ({'client_id': CLIENT_ID, 'exp': int(time.time()) - 3600}, 'expired'),
+    ({'aud': CLIENT_ID}, 'not an access token'),  # id_token вместо access-токена
+])
+def test_invalid_access_tokens(client, keyset, claims, error):
+    with pytest.raises(InvalidToken, match=error):
+        client.verify_token(token(keyset, **claims))
+
+
+def test_tampered_token(client, keyset):
+    header, payload, signature = token(keyset, client_id=CLIENT_ID).split('.')
+    forged = tokens._json_segment({'iss': ISSUER, 'sub': '1', 'client_id': CLIENT_ID, 'exp': int(time.time()) + 600})
+    with pytest.raises(InvalidToken, match='bad signature'):
+        client.verify_token(f'{header}.{forged}.{signature}')
+
+
+def test_id_token(client, keyset):
+    id_token = token(keyset, aud=CLIENT_ID, nonce='n1')
+    assert client.verify_id_token(id_token, nonce='n1')['sub'] == '7'
+    with pytest.raises(InvalidToken, match='nonce'):
+        client.verify_id_token(id_token, nonce='n2')
+    with pytest.raises(InvalidToken, match='audience'):
+        client.verify_id_token(token(keyset, aud='2000000002', nonce='n1'), nonce='n1')
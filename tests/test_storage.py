@@ -0,0 +1,200 @@
+"""Контракт Storage: тесты работают только через интерфейс хранилища.
+
+Гоняются на SQLiteStorage в пустой базе; другой бэкенд подключается своей
+фикстурой storage с тем же набором тестов.
+"""
+import time
+
+import pytest
+
+from db import ConnectionPool
+from storage import IntegrityError, SQLiteStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SQLiteStorage(ConnectionPool(str(tmp_path / 'skyid.db'), size=2))
+    storage.migrate()
+    return storage
+
+
+@pytest.fixture
+def user_id(storage):
+    return storage.create_user('alice', 'hash', 'Алиса')
+
+
+@pytest.fixture
+def client_id(storage, user_id):
+    storage.create_app('1000000001', 'k' * 64, user_id, 'Shop', 'http://rp/cb')
+    return '1000000001'
+
+
+# --- СХЕМА ---
+
+def test_migrate_is_idempotent(storage):
+    assert storage.schema_version() == storage.latest_version()
+    assert storage.migrate() == []
+
+
+def test_migrate_applies_every_step(tmp_path):
+    storage = SQLiteStorage(ConnectionPool(str(tmp_path / 'new.db'), size=1))
+    assert storage.schema_version() == 0
+    assert storage.migrate() == list(range(1, storage.latest_version() + 1))
+
+
+# --- ПОЛЬЗОВАТЕЛИ И ПРИЛОЖЕНИЯ ---
+
+def test_users(storage, user_id):
+    assert storage.get_user(user_id) == {'id': user_id, 'username': 'alice', 'name': 'Алиса'}
+    assert storage.get_user_by_username('alice')['password'] == 'hash'
+    assert storage.get_user_by_username('bob') is None
+    storage.update_password(user_id, 'new-hash')
+    assert storage.get_user_by_username('alice')['password'] == 'new-hash'
+
+
+def test_duplicate_username(storage, user_id):
+    with pytest.raises(IntegrityError):
+        storage.create_user('alice', 'hash', 'Другая Алиса')
+
+
+def test_list_apps_pages_by_client_id(storage, user_id):
+    for i in range(5):
+        storage.create_app(f'100000000{i}', 'k' * 64, user_id, f'App {i}', 'http://rp/cb')
+    storage.create_app('2000000000', 'k' * 64, user_id + 1, 'Чужое', 'http://rp/cb')
+    first = storage.list_apps(user_id, limit=3)
+    rest = storage.list_apps(user_id, after=first[-1]['client_id'], limit=3)
+    assert [a['client_id'] for a in first + rest] == [f'100000000{i}' for i in range(5)]
+    assert storage.get_app('1000000002')['app_name'] == 'App 2'
+    assert storage.get_app('3000000000') is None
+
+
+# --- КОДЫ АВТОРИЗАЦИИ ---
+
+def test_auth_code_is_taken_once(storage, user_id, client_id):
+    storage.save_auth_code('code-1', user_id, client_id, scope='openid', nonce='n', redirect_uri='http://rp/cb',
+                           code_challenge='c' * 43, code_challenge_method='S256')
+    assert storage.count_auth_codes() == 1
+    assert storage.take_auth_code('code-1', 'other-client', 600) is None
+    code = storage.take_auth_code('code-1', client_id, 600)
+    assert (code['user_id'], code['scope'], code['nonce'], code['code_challenge_method']) == (user_id, 'openid', 'n',
+                                                                                           'S256')
+    assert storage.take_auth_code('code-1', client_id, 600) is None
+    assert storage.count_auth_codes() == 0
+
+
+def test_duplicate_auth_code(storage, user_id, client_id):
+    storage.save_auth_code('code-1', user_id, client_id)
+    with pytest.raises(IntegrityError):
+        storage.save_auth_code('code-1', user_id, client_id)
+
+
+def test_expired_auth_code(storage, user_id, client_id):
+    storage.save_auth_code('code-1', user_id, client_id)
+    # max_age < 0: код "создан" раньше допустимого
+    assert storage.take_auth_code('code-1', client_id, -5) is None
+
+
+# --- РАЗРЕШЕНИЯ ---
+
+def test_grants(storage, user_id, client_id):
+    storage.save_grant(user_id, client_id, 'openid', 100)
+    storage.save_grant(user_id, client_id, 'openid profile', 200)
+    assert storage.get_grant(user_id, client_id)['scope'] == 'openid profile'
+    assert storage.list_grants(user_id) == [{'client_id': client_id, 'scope': 'openid profile', 'granted_at': 200,
+                                             'app_name': 'Shop'}]
+    assert storage.delete_grant(user_id, client_id) is True
+    assert storage.delete_grant(user_id, client_id) is False
+    assert storage.get_grant(user_id, client_id) is None
+
+
+def test_granted_users(storage, client_id):
+    ids = [storage.create_user(f'user{i}', 'hash', f'User {i}') for i in range(5)]
+    for user_id in ids[:4]:
+        storage.save_grant(user_id, client_id, 'openid', 100)
+    found = storage.get_granted_users(client_id, [ids[0], ids[4], 10 ** 6])
+    assert [u['id'] for u in found] == [ids[0]]
+    first = storage.list_granted_users(client_id, limit=3)
+    rest = storage.list_granted_users(client_id, after=first[-1]['id'], limit=3)
+    assert [u['id'] for u in first + rest] == ids[:4]
+
+
+# --- ТОКЕНЫ И КЛЮЧИ ---
+
+def test_access_tokens(storage, user_id, client_id):
+    now = int(time.time())
+    storage.save_access_token('live', user_id, client_id, now, now + 3600)
+    storage.save_access_token('expired', user_id, client_id, now - 7200, now - 3600)
+    token = storage.get_access_token('live', now)
+    assert (token['user_id'], token['client_id'], token['username']) == (user_id, client_id, 'alice')
+    assert storage.get_access_token('expired', now) is None
+    # Отозвать токен может только приложение, которому он выдан
+    storage.delete_access_token('live', 'other-client')
+    assert storage.get_access_token('live', now) is not None
+    storage.delete_access_token('live', client_id)
+    assert storage.get_access_token('live', now) is None
+
+
+def test_sweep_expired(storage, user_id, client_id):
+    now = int(time.time())
+    storage.save_access_token('live', user_id, client_id, now, now + 3600)
+    storage.save_access_token('expired', user_id, client_id, now - 7200, now - 3600)
+    storage.save_auth_code('code-1', user_id, client_id)
+    assert storage.sweep_expired(-5, 1) == 2
+    assert storage.count_auth_codes() == 0
+    assert storage.get_access_token('live', now) is not None
+
+
+def test_signing_keys_are_pruned(storage):
+    storage.save_signing_key('old', b'\x01' * 32, 100, 0)
+    storage.save_signing_key('new', b'\x02' * 32, 300, 200)
+    assert [(kid, bytes(raw), created) for kid, raw, created in storage.load_signing_keys()] == [
+        ('new', b'\x02' * 32, 300)]
+
+
+# --- ВЕБХУКИ ---
+
+def test_webhook_events_need_webhook_url(storage, user_id, client_id):
+    storage.save_grant(user_id, client_id, 'openid', 100, webhook_event=('user.authorized', {'user_id': user_id}))
+    assert storage.webhook_stats() == []
+    storage.set_webhook(client_id, 'https://rp.example/hook', 's' * 64)
+    storage.delete_grant(user_id, client_id, webhook_event=('user.revoked', {'user_id': user_id}))
+    assert [(s['status'], s['count']) for s in storage.webhook_stats()] == [('pending', 1)]
+
+
+def test_claimed_webhooks_are_leased(storage, user_id, client_id):
+    storage.set_webhook(client_id, 'https://rp.example/hook', 's' * 64)
+    for i in range(3):
+        storage.save_grant(user_id + i, client_id, 'openid', 100, webhook_event=('user.authorized', {'i': i}))
+    now = time.time() + 1
+    events = storage.claim_webhooks(now, 60, 10)
+    assert [e['event'] for e in events] == ['user.authorized'] * 3
+    assert storage.claim_webhooks(now, 60, 10) == []
+    first, second, third = (e['id'] for e in events)
+    storage.finish_webhooks([first], [(1, now, 'HTTP 500', second)], [(10, 'HTTP 500', third)])
+    assert [e['id'] for e in storage.claim_webhooks(now, 60, 10)] == [second]
+    assert storage.retry_dead_webhooks(now, client_id) == 1
+    assert [e['id'] for e in storage.claim_webhooks(now, 60, 10)] == [third]
+
+
+# --- АУДИТ И МАССОВЫЙ ПЕРЕНОС ---
+
+def test_audit_events(storage):
+    storage.save_audit_events([(100.0 + i, 'login' if i % 2 else 'logout', i, None, '127.0.0.1', '{}')
+                               for i in range(10)])
+    assert len(list(storage.iter_audit_events(batch_size=3))) == 10
+    logins = list(storage.iter_audit_events(event='login', since=103, until=108, batch_size=2))
+    assert [e['user_id'] for e in logins] == [3, 5, 7]
+
+
+def test_import_and_export(storage, user_id):
+    rows = [('alice', 'hash', 'Дубль'), ('bob', 'hash-b', 'Боб')]
+    assert storage.import_users(rows) == 1
+    assert storage.import_users([(500, 'carol', 'hash-c', 'Кэрол')], keep_ids=True) == 1
+    exported = list(storage.export_rows('users', batch_size=1))
+    assert [(u['username'], u['password_hash']) for u in exported] == [('alice', 'hash'), ('bob', 'hash-b'),
+                                                                       ('carol', 'hash-c')]
+    assert exported[-1]['id'] == 500
+    apps = [('1000000001', 'k' * 64, user_id, 'Shop', 'http://rp/cb')]
+    assert storage.import_apps(apps) == 1
+    assert storage.import_apps(apps) == 0
+    assert [a['client_id'] for a in storage.export_rows('apps')] == ['1000000001']
@@ -0,0 +1,97 @@
+import asyncio
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import webhooks
+
+
+# --- АДРЕСА ---
+
+@pytest.mark.parametrize('address', [
+    '127.0.0.1', '10.0.0.1', '172.16.0.1', '192.168.1.1', '169.254.169.254', '100.64.0.1', '0.0.0.0',
+    '224.0.0.1', '::1', 'fe80::1%eth0', 'fc00::1', '::ffff:127.0.0.1',
+    '64:ff9b::7f00:1', '64:ff9b::a9fe:a9fe', '2002:7f00:1::', '2002:a00:1::',
+    '2001:0:4136:e378:8000:63bf:80ff:fffe',  # Teredo, клиент 127.0.0.1
+])
+def test_private_addresses_are_rejected(address):
+    with pytest.raises(webhooks.UnsafeAddress):
+        webhooks.check_addresses([address])
+
+
+@pytest.mark.parametrize('address', ['93.184.216.34', '2606:4700:4700::1111', '64:ff9b::808:808'])
+def test_public_addresses_are_accepted(address):
+    webhooks.check_addresses([address])
+
+
+def test_one_private_address_is_enough():
+    with pytest.raises(webhooks.UnsafeAddress):
+        webhooks.check_addresses(['93.184.216.34', '10.0.0.1'])
+    with pytest.raises(webhooks.UnsafeAddress):
+        webhooks.check_addresses([])
+    webhooks.check_addresses(['127.0.0.1'], allow_private=True)
+
+
+def test_check_url():
+    assert webhooks.check_url('ftp://example.com/hook') is not None
+    assert webhooks.check_url('http://127.0.0.1:8080/hook') is not None
+    assert webhooks.check_url('http://[::1]/hook') is not None
+    assert webhooks.check_url('http://127.0.0.1:8080/hook', allow_private=True) is None
+
+
+# --- СОЕДИНЕНИЕ С ПРОВЕРЕННЫМ АДРЕСОМ ---
+
+@pytest.fixture
+def receiver():
+    """Локальный получатель вебхуков; в список - заголовки Host принятых запросов."""
+    hosts = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            hosts.append(self.headers['Host'])
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_port, hosts
+    server.shutdown()
+
+
+def post_through_resolver(port, answers, allow_private):
+    """POST через клиент диспетчера; хост rebind.test разрешается в answers по очереди."""
+    lookups = []
+
+    async def getaddrinfo(host, port, **kwargs):
+        lookups.append(host)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (answers[len(lookups) - 1], port))]
+
+    async def post():
+        asyncio.get_running_loop().getaddrinfo = getaddrinfo
+        dispatcher = webhooks.WebhookDispatcher(None, None, allow_private=allow_private)
+        async with dispatcher.create_client() as client:
+            return await client.post(f'http://rebind.test:{port}/hook', content=b'{}')
+
+    return asyncio.run(post()), lookups
+
+
+def test_connects_to_the_vetted_address(receiver):
+    port, hosts = receiver
+    # Второй ответ DNS увел бы запрос в другую сеть - его не должно быть вовсе
+    response, lookups = post_through_resolver(port, ['127.0.0.1', '10.255.255.1'], allow_private=True)
+    assert response.status_code == 204
+    assert lookups == ['rebind.test']
+    assert hosts == [f'rebind.test:{port}']
+
+
+def test_private_answer_is_not_contacted(receiver):
+    port, hosts = receiver
+    with pytest.raises(webhooks.UnsafeAddress):
+        post_through_resolver(port, ['127.0.0.1'], allow_private=False)
+    assert hosts == []
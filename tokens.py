@@ -0,0 +1,163 @@
+"""Подписанные access-токены SkyID (JWT, EdDSA/Ed25519) и набор ключей подписи.
+
+Токен самодостаточен: в нём лежат sub, client_id, iat, exp и профиль
+пользователя, поэтому /oauth/userinfo и сервисы-потребители проверяют его
+в памяти по публичному ключу из /.well-known/jwks.json, без обращения к БД.
+"""
+import base64
+import json
+import secrets
+import threading
+import time
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def b64url_decode(data):
+    if isinstance(data, str):
+        data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def _json_segment(obj):
+    return b64url_encode(json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+
+
+# --- НАБОР КЛЮЧЕЙ ---
+
+class KeySet:
+    """Ключи подписи, закешированные в процессе.
+
+    Сами ключи хранятся в БД (load_keys / save_key), чтобы все воркеры
+    gunicorn подписывали и проверяли одним и тем же набором. Активным
+    считается самый новый ключ; предыдущие остаются для проверки токенов,
+    выпущенных до ротации, пока те не истекут.
+    """
+
+    # Как часто можно перечитывать ключи из БД при встрече неизвестного kid
+    RELOAD_THROTTLE = 30
+    # Через сколько секунд перечитывать ключи в любом случае: ключ, выпущенный
+    # flask rotate-keys или другим воркером, начинает подписывать и попадает в JWKS
+    REFRESH_INTERVAL = 60
+
+    def __init__(self, load_keys, save_key, rotation_interval, token_ttl):
+        self._load_keys = load_keys
+        self._save_key = save_key
+        self.rotation_interval = rotation_interval
+        self.token_ttl = token_ttl
+        self._lock = threading.Lock()
+        self._keys = {}          # kid -> (created_at, private_key, public_key)
+        self._active = None      # kid
+        self._loaded_at = 0
+
+    def _reload(self):
+        keys = {}
+        for kid, raw, created_at in self._load_keys():
+            key = Ed25519PrivateKey.from_private_bytes(bytes(raw))
+            keys[kid] = (created_at, key, key.public_key())
+        self._keys = keys
+        self._active = max(keys, key=lambda k: keys[k][0]) if keys else None
+        self._loaded_at = time.time()
+
+    def _reload_if_stale(self, now):
+        if now - self._loaded_at >= self.REFRESH_INTERVAL:
+            self._reload()
+
+    def _active_expired(self, now):
+        return self._active is None or now - self._keys[self._active][0] >= self.rotation_interval
+
+    def rotate(self):
+        """Создает новый ключ и делает его активным."""
+        with self._lock:
+            return self._rotate_locked()
+
+    def _rotate_locked(self):
+        now = int(time.time())
+        kid = time.strftime('%Y%m%d', time.gmtime(now)) + '-' + secrets.token_hex(4)
+        key = Ed25519PrivateKey.generate()
+        # Ключи старше интервала ротации + срока жизни токена больше ничего не проверяют
+        self._save_key(kid, key.private_bytes_raw(), now, now - self.rotation_interval - self.token_ttl)
+        self._reload()
+        return kid
+
+    def signing_key(self):
+        now = time.time()
+        with self._lock:
+            self._reload_if_stale(now)
+            if self._active_expired(now):
+                # Возможно, другой воркер уже выполнил ротацию
+                self._reload()
+                if self._active_expired(now):
+                    self._rotate_locked()
+            return self._active, self._keys[self._active][1]
+
+    def public_key(self, kid):
+        entry = self._keys.get(kid)
+        if entry is None and time.time() - self._loaded_at >= self.RELOAD_THROTTLE:
+            with self._lock:
+                self._reload()
+            entry = self._keys.get(kid)
+        return entry[2] if entry else None
+
+    def jwks(self):
+        with self._lock:
+            self._reload_if_stale(time.time())
+        if not self._keys:
+            self.signing_key()
+        keys = []
+        for kid, (created_at, _, public_key) in sorted(self._keys.items(), key=lambda item: -item[1][0]):
+            raw = public_key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+            keys.append({'kty': 'OKP', 'crv': 'Ed25519', 'use': 'sig', 'alg': 'EdDSA',
+                         'kid': kid, 'x': b64url_encode(raw)})
+        return {'keys': keys}
+
+
+# --- КОДИРОВАНИЕ / ПРОВЕРКА ---
+
+def encode(claims, keyset):
+    kid, key = keyset.signing_key()
+    signing_input = _json_segment({'alg': 'EdDSA', 'typ': 'JWT', 'kid': kid}) + '.' + _json_segment(claims)
+    signature = key.sign(signing_input.encode('ascii'))
+    return signing_input + '.' + b64url_encode(signature)
+
+
+def decode(token, keyset, leeway=30):
+    """Проверяет подпись и срок действия, возвращает claims."""
+    try:
+        header_b64, payload_b64, signature_b64 = token.split('.')
+        header = json.loads(b64url_decode(header_b64))
+        signature = b64url_decode(signature_b64)
+    except (ValueError, TypeError):
+        raise InvalidToken('malformed token')
+
+    if not isinstance(header, dict) or header.get('alg') != 'EdDSA':
+        raise InvalidToken('unsupported algorithm')
+    if not isinstance(header.get('kid'), str):
+        raise InvalidToken('missing key id')
+    public_key = keyset.public_key(header['kid'])
+    if public_key is None:
+        raise InvalidToken('unknown key id')
+    try:
+        public_key.verify(signature, (header_b64 + '.' + payload_b64).encode('ascii'))
+    except InvalidSignature:
+        raise InvalidToken('bad signature')
+
+    try:
+        claims = json.loads(b64url_decode(payload_b64))
+    except ValueError:
+        raise InvalidToken('malformed payload')
+    if not isinstance(claims, dict) or not isinstance(claims.get('exp'), int):
+        raise InvalidToken('missing exp')
+    if claims['exp'] + leeway < time.time():
+        raise InvalidToken('token expired')
+    return claims
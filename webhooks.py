@@ -0,0 +1,298 @@
+"""Доставка вебхуков приложениям SkyID.
+
+События (user.authorized, user.revoked) пишутся в таблицу webhook_outbox той
+же транзакцией, что и изменение разрешения, - запрос сам ничего не отправляет.
+WebhookDispatcher в отдельном потоке (или процессе flask webhooks-worker)
+забирает созревшие события пачками и рассылает их в своем цикле событий:
+
+  - события одного приложения уходят одним POST {"events": [...]},
+    не больше max_batch в запросе;
+  - общий пул соединений httpx с keep-alive, к одному адресу - не больше
+    per_endpoint запросов одновременно; каждый POST - отдельная задача, так что
+    медленный получатель не задерживает остальных и следующие пачки;
+  - ответ 2xx - событие удаляется; иначе повтор через экспоненциальную паузу
+    со случайной составляющей, после max_attempts попыток событие остается
+    в таблице со статусом dead (flask webhooks --retry-dead вернет его в очередь).
+
+Адрес вебхука задает владелец приложения, поэтому слать туда можно только в
+публичную сеть: хост разрешается при сохранении адреса и при каждой
+доставке, адреса loopback, частных, link-local и зарезервированных сетей
+(в том числе зашитые в IPv6 через NAT64 и 6to4) отклоняются, а соединение
+идет на проверенный адрес (PinnedTransport). allow_private - для локальной
+разработки. Перенаправления не выполняются.
+
+Подпись: X-SkyID-Signature: t=<unix time>,v1=<hex HMAC-SHA256(secret, "<t>.<тело>")>.
+Доставка - "хотя бы один раз" и без гарантии порядка: получатель
+отбрасывает повторы по id события.
+"""
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import random
+import socket
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import metrics
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - без httpx вебхуки не доставляются
+    httpx = None
+
+
+class UnsafeAddress(ValueError):
+    pass
+
+
+NAT64_PREFIX = ipaddress.ip_network('64:ff9b::/96')
+
+
+def embedded_ipv4(ip):
+    """IPv4-адреса, зашитые в IPv6: mapped, 6to4, NAT64, Teredo (клиент)."""
+    if ip.version != 6:
+        return []
+    embedded = [ip.ipv4_mapped, ip.sixtofour, ip.teredo and ip.teredo[1]]
+    if ip in NAT64_PREFIX:
+        embedded.append(ipaddress.IPv4Address(int(ip) & 0xFFFFFFFF))
+    return [address for address in embedded if address is not None]
+
+
+def check_addresses(addresses, allow_private=False):
+    """Бросает UnsafeAddress, если хоть один адрес хоста не из публичной сети."""
+    if not addresses:
+        raise UnsafeAddress('host has no addresses')
+    if allow_private:
+        return
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])  # у link-local IPv6 бывает %интерфейс
+        # 64:ff9b::7f00:1 и 2002:7f00:1:: сами по себе "публичные", но ведут на 127.0.0.1
+        for candidate in [ip] + embedded_ipv4(ip):
+            if not candidate.is_global or candidate.is_multicast:
+                raise UnsafeAddress(f'{address} is not a public address')
+
+
+def _port(parts):
+    return parts.port or (443 if parts.scheme == 'https' else 80)
+
+
+def check_url(url, allow_private=False):
+    """Ошибка для владельца приложения или None, если адрес годится."""
+    try:
+        parts = urlsplit(url)
+        port = _port(parts)
+    except ValueError:
+        return 'Некорректный адрес вебхука'
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        return 'Адрес вебхука должен начинаться с http:// или https://'
+    try:
+        infos = socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+        check_addresses([info[4][0] for info in infos], allow_private)
+    except OSError:
+        return 'Не удалось найти хост вебхука'
+    except UnsafeAddress:
+        return 'Вебхук может вести только на публичный адрес в интернете'
+    return None
+
+
+if httpx is not None:
+
+    class PinnedTransport(httpx.AsyncBaseTransport):
+        """Транспорт доставки: соединяется с тем адресом, который прошел проверку.
+
+        Хост разрешается один раз на запрос, адреса проверяются check_addresses(),
+        и запрос уходит на первый из них - повторного разрешения, которое подменило
+        бы адрес после проверки (DNS rebinding), нет. Заголовок Host и SNI/проверка
+        сертификата остаются по имени хоста; у каждого хоста свой пул соединений,
+        чтобы TLS-соединение одного имени не досталось другому на том же адресе.
+        """
+
+        def __init__(self, allow_private=False, **transport_options):
+            self.allow_private = allow_private
+            self._options = transport_options
+            self._transports = {}  # имя хоста -> httpx.AsyncHTTPTransport
+
+        async def handle_async_request(self, request):
+            host, port = request.url.host, request.url.port or (443 if request.url.scheme == 'https' else 80)
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            addresses = [info[4][0] for info in infos]
+            check_addresses(addresses, self.allow_private)
+            transport = self._transports.get(host)
+            if transport is None:
+                transport = self._transports[host] = httpx.AsyncHTTPTransport(**self._options)
+            request.url = request.url.copy_with(host=addresses[0])
+            request.extensions = dict(request.extensions, sni_hostname=host)
+            return await transport.handle_async_request(request)
+
+        async def aclose(self):
+            for transport in self._transports.values():
+                await transport.aclose()
+
+
+def sign(secret, timestamp, body):
+    mac = hmac.new(secret.encode(), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={mac}'
+
+
+def backoff(attempts, base, cap):
+    # Случайная составляющая разводит повторы событий, упавших одновременно
+    return random.uniform(0.5, 1.0) * min(cap, base * 2 ** (attempts - 1))
+
+
+# Событие ждало своей очереди к получателю дольше аренды и не отправлялось
+LEASE_EXPIRED = 'lease expired before delivery'
+
+
+class WebhookDispatcher:
+
+    def __init__(self, storage, get_endpoint, batch_size=200, max_batch=50, per_endpoint=4, timeout=10.0,
+                 max_attempts=10, backoff_base=10.0, backoff_cap=6 * 3600, poll_interval=1.0, lease=120,
+                 allow_private=False, max_in_flight=100):
+        self.storage = storage
+        self.get_endpoint = get_endpoint  # client_id -> запись приложения (webhook_url, webhook_secret)
+        self.batch_size = batch_size
+        self.max_batch = max_batch
+        self.per_endpoint = per_endpoint
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.allow_private = allow_private
+        self.max_in_flight = max_in_flight  # одновременных POST-задач на весь диспетчер
+        self._tasks = set()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Запускает фоновый поток диспетчера - один на процесс (после fork - заново)."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            if httpx is None:
+                print("--- WEBHOOKS: доставка выключена, нужен пакет httpx (pip install httpx) ---")
+                return
+            threading.Thread(target=self.run_forever, name='skyid-webhooks', daemon=True).start()
+
+    def run_forever(self):
+        if httpx is None:
+            raise RuntimeError('Webhook delivery requires: pip install httpx')
+        asyncio.run(self.run())
+
+    def create_client(self):
+        limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        return httpx.AsyncClient(timeout=self.timeout, follow_redirects=False,
+                                 transport=PinnedTransport(self.allow_private, limits=limits))
+
+    async def run(self):
+        semaphores = defaultdict(lambda: asyncio.Semaphore(self.per_endpoint))
+        async with self.create_client() as client:
+            while True:
+                try:
+                    claimed = await self.dispatch_once(client, semaphores)
+                except Exception as e:
+                    if not threading.main_thread().is_alive():
+                        return  # интерпретатор завершается, пулы потоков уже не принимают задачи
+                    print(f"--- WEBHOOKS: ошибка доставки: {e} ---")
+                    claimed = 0
+                # Полная пачка - в очереди, скорее всего, есть еще: берем сразу
+                if claimed < self.batch_size:
+                    await asyncio.sleep(self.poll_interval)
+
+    async def dispatch_once(self, client, semaphores, wait=False):
+        """Забирает пачку событий и запускает их доставку, не дожидаясь ответов.
+
+        Каждая пачка одного приложения доставляется своей задачей: медленный
+        получатель занимает только свой семафор, а следующие события забираются
+        сразу. Если задач и так слишком много, сначала ждем, пока часть завершится.
+        wait=True - дождаться доставки всего забранного (разовый прогон).
+        """
+        while len(self._tasks) >= self.max_in_flight:
+            await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+        claimed_at = time.time()
+        events = await asyncio.to_thread(self.storage.claim_webhooks, claimed_at, self.lease, self.batch_size)
+        by_client = defaultdict(list)
+        for event in events:
+            by_client[event['client_id']].append(event)
+
+        started, dead = [], []
+        for client_id, group in by_client.items():
+            endpoint = await asyncio.to_thread(self.get_endpoint, client_id)
+            if not endpoint or not endpoint.get('webhook_url'):
+                # Вебхук выключили, пока события ждали: оставляем их в dead до повторного включения
+                dead += [(event['attempts'], 'webhook disabled', event['id']) for event in group]
+                continue
+            for start in range(0, len(group), self.max_batch):
+                task = asyncio.create_task(self._deliver(client, semaphores[endpoint['webhook_url']], endpoint,
+                                                         group[start:start + self.max_batch], claimed_at))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                started.append(task)
+        if dead:
+            await asyncio.to_thread(self.storage.finish_webhooks, [], [], dead)
+            metrics.webhook_events('dead', len(dead))
+        if wait and started:
+            await asyncio.wait(started)
+        return len(events)
+
+    async def _deliver(self, client, semaphore, endpoint, chunk, claimed_at):
+        try:
+            error = await self._post(client, semaphore, endpoint, chunk, claimed_at)
+            await asyncio.to_thread(self._finish, chunk, error)
+        except Exception as e:
+            # События остались за нами до конца аренды, потом их заберут снова
+            if threading.main_thread().is_alive():
+                print(f"--- WEBHOOKS: ошибка доставки: {e} ---")
+
+    async def _post(self, client, semaphore, endpoint, chunk, claimed_at):
+        """None - доставлено, иначе текст ошибки."""
+        body = json.dumps({'events': [{'id': event['id'], 'type': event['event'], 'created_at': event['created_at'],
+                                       'data': json.loads(event['payload'])} for event in chunk]}).encode()
+        async with semaphore:
+            if time.time() + self.timeout > claimed_at + self.lease:
+                # Очередь к медленному получателю пережила аренду: другой диспетчер
+                # может уже забрать эти события - не отправляем, чтобы не было дублей
+                return LEASE_EXPIRED
+            headers = {
+                'Content-Type': 'application/json',
+                'User-Agent': 'SkyID-Webhooks/1.0',
+                'X-SkyID-Signature': sign(endpoint['webhook_secret'], int(time.time()), body),
+            }
+            try:
+                response = await client.post(endpoint['webhook_url'], content=body, headers=headers)
+            except (httpx.HTTPError, OSError, UnsafeAddress) as e:
+                # OSError и UnsafeAddress - из PinnedTransport: хост не нашелся или ведет не туда
+                return f'{type(e).__name__}: {e}'[:500]
+        if 200 <= response.status_code < 300:
+            return None
+        return f'HTTP {response.status_code}'
+
+    def _finish(self, chunk, error):
+        if error is None:
+            self.storage.finish_webhooks([event['id'] for event in chunk], [], [])
+            metrics.webhook_events('delivered', len(chunk))
+            return
+        retries, dead = [], []
+        for event in chunk:
+            if error == LEASE_EXPIRED:
+                # Попытки не было - не считаем ее и возвращаем событие в очередь сразу
+                retries.append((event['attempts'], time.time(), error, event['id']))
+                continue
+            attempts = event['attempts'] + 1
+            if attempts >= self.max_attempts:
+                dead.append((attempts, error, event['id']))
+            else:
+                retries.append((attempts, time.time() + backoff(attempts, self.backoff_base, self.backoff_cap),
+                                error, event['id']))
+        self.storage.finish_webhooks([], retries, dead)
+        metrics.webhook_events('retry', len(retries))
+        metrics.webhook_events('dead', len(dead))